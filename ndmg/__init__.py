@@ -5,6 +5,7 @@ from .graph.graph import graph as graph
 from .utils import utils
 from .register.register import register as register
 from .track.track import track as track
+from .timeseries.timeseries import timeseries as timeseries
 from .stats import *
 # from .preproc.preproc import preproc as preproc
 from .scripts import ndmg_dwi_pipeline as ndmg_dwi_pipeline
@@ -21,11 +21,19 @@
 
 from __future__ import print_function
 
-from itertools import combinations
-from collections import defaultdict
+from multiprocessing import Pool
+from collections import deque
+from itertools import islice
+from scipy import sparse
 import numpy as np
 import networkx as nx
-import nibabel as nb
+from ndmg.utils import utils as mgu
+from ndmg.utils.loadGraphs import write_npz_graph
+from ndmg.utils.fibers import flatten_streamlines, tractogram, mmap_npz
+import os.path as op
+import tempfile
+import hashlib
+import shutil
 import ndmg
 import time
 
@@ -38,7 +46,8 @@ class graph(object):
         **Positional Arguments:**
 
                 N:
-                    - Number of rois
+                    - Number of rois. If None, it is taken from the number of
+                      non-zero labels in rois.
                 rois:
                     - Set of ROIs as either an array or niftii file)
                 attr:
@@ -47,12 +56,21 @@ class graph(object):
                       dimensional will be interpretted as node attributes. If
                       it is any other dimensional, it will be ignored.
         """
-        self.N = N
-        self.edge_dict = defaultdict(int)
-
-        self.rois = nb.load(rois).get_data()
+        if isinstance(rois, np.ndarray):
+            self.rois = rois
+        else:
+            self.rois = mgu.load_data(rois)
         n_ids = np.unique(self.rois)
         n_ids = n_ids[n_ids != 0]
+        self.N = len(n_ids) if N is None else N
+
+        # Edges are counted between node indices (positions in n_ids)
+        self.n_ids = n_ids.astype(np.int64)
+        self.lut = np.zeros(self.n_ids.max() + 1 if len(n_ids) else 1,
+                            dtype=np.int64)
+        self.lut[self.n_ids] = np.arange(len(n_ids))
+        self.edges = edge_accumulator(len(n_ids))
+        self._synced = True
 
         self.g = nx.Graph(name="Generated by NeuroData's MRI Graphs (ndmg)",
                           date=time.asctime(time.localtime()),
@@ -62,50 +80,147 @@ class graph(object):
                           ecount=0,
                           vcount=len(n_ids)
                           )
-        print(self.g.graph)
-
         [self.g.add_node(ids) for ids in n_ids]
         pass
 
-    def make_graph(self, streamlines, attr=None):
+    def make_graph(self, streamlines, attr=None, nproc=1, progress=None,
+                   index=False):
         """
         Takes streamlines and produces a graph
 
         **Positional Arguments:**
 
                 streamlines:
-                    - Fiber streamlines either file or array in a dipy EuDX
-                      or compatible format.
+                    - Fiber streamlines either file, array, or generator in
+                      a dipy EuDX or compatible format. Files are graphed
+                      from their voxelized cache (see load_voxels), and
+                      generators are consumed a chunk at a time.
+
+        **Optional Arguments:**
+
+                nproc:
+                    - Number of processes to shard the streamlines across
+                progress:
+                    - ndmg.utils progress object to report throughput to
+                index:
+                    - Whether to record which streamlines make up each edge
+                      (see save_edge_index)
+        """
+        fill_graphs([self], streamlines, nproc, progress=progress,
+                    index=index)
+
+    def add_voxels(self, vox, offsets, lengths=None):
         """
-        nlines = np.shape(streamlines)[0]
-        print("# of Streamlines: " + str(nlines))
+        Adds edges for streamlines that have already been rounded to voxels
 
-        for idx, streamline in enumerate(streamlines):
-            if (idx % int(nlines*0.05)) == 0:
-                print(idx)
+        **Positional Arguments:**
 
-            points = np.round(streamline).astype(int)
-            p = set()
-            for point in points:
-                try:
-                    loc = self.rois[point[0], point[1], point[2]]
-                except IndexError:
-                    pass
-                else:
-                    pass
+                vox:
+                    - Flat [npoints]x3 integer voxel array, as returned by
+                      voxelize
+                offsets:
+                    - Streamline offsets into vox, as returned by
+                      flatten_streamlines
 
-                if loc:
-                    p.add(loc)
+        **Optional Arguments:**
 
-            edges = combinations(p, 2)
-            for edge in edges:
-                lst = tuple([int(node) for node in edge])
-                self.edge_dict[tuple(sorted(lst))] += 1
+                lengths:
+                    - Length of each streamline, as returned by
+                      streamline_lengths. Without them only the count layer
+                      of the edges is filled.
+        """
+        count_edges(self.edges, vox, offsets, self.rois, self.lut, lengths)
+        self._synced = False
+
+    def add_streamlines(self, streamlines, nproc=1, progress=None):
+        """
+        Adds a batch of streamlines to the edges counted so far
+
+        **Positional Arguments:**
+
+                streamlines:
+                    - Fiber streamlines either file, array, or generator in
+                      a dipy EuDX or compatible format.
 
-        edge_list = [(k[0], k[1], v) for k, v in self.edge_dict.items()]
-        self.g.add_weighted_edges_from(edge_list)
+        **Optional Arguments:**
+
+                nproc:
+                    - Number of processes to shard the streamlines across
+                progress:
+                    - ndmg.utils progress object to report throughput to
+        """
+        fill_graphs([self], streamlines, nproc, progress=progress)
+
+    def subtract_streamlines(self, streamlines, chunksize=100000):
+        """
+        Removes a batch of previously added streamlines from the edge counts
+
+        **Positional Arguments:**
+
+                streamlines:
+                    - Fiber streamlines either file, array, or generator in
+                      a dipy EuDX or compatible format.
+
+        **Optional Arguments:**
+
+                chunksize:
+                    - Number of streamlines counted at a time
+        """
+        if self.edges.members is not None:
+            raise ValueError("Cannot subtract streamlines from a graph that "
+                             "records its edge index")
+        batch = edge_accumulator(len(self.n_ids))
+        for cvox, coff, clen, _ in voxel_chunks(streamlines, chunksize):
+            count_edges(batch, cvox, coff, self.rois, self.lut, clen)
+        self.edges.subtract(batch)
+        self._synced = False
+
+    def merge(self, other):
+        """
+        Adds the edge counts of another graph over the same parcellation,
+        such as one built from a different shard of the tractogram
+
+        **Positional Arguments:**
 
-    def cor_graph(self, timeseries, attr=None):
+                other:
+                    - graph object, or the filename of counts written by
+                      save_counts
+        """
+        if isinstance(other, str):
+            n_ids, edges = load_counts(other)
+        else:
+            n_ids, edges = other.n_ids, other.edges
+        if not np.array_equal(n_ids, self.n_ids):
+            raise ValueError("Cannot merge graphs over different ROIs")
+        self.edges.merge(edges)
+        self._synced = False
+
+    def save_counts(self, fname):
+        """
+        Saves the raw edge counts, so that partial graphs built elsewhere can
+        be combined with merge
+
+        **Positional Arguments:**
+
+                fname:
+                    - Filename for the .npz counts
+        """
+        e = self.edges
+        arrays = dict(n_ids=self.n_ids, nlines=e.nlines)
+        for name in ('counts', 'lengths', 'inv_lengths'):
+            mat = getattr(e, name)
+            arrays.update({name + '_data': mat.data,
+                           name + '_indices': mat.indices,
+                           name + '_indptr': mat.indptr})
+        if e.members is not None:
+            arrays['member_pairs'] = np.concatenate(
+                [m[0] for m in e.members] + [np.zeros(0, dtype=np.int64)])
+            arrays['member_sids'] = np.concatenate(
+                [m[1] for m in e.members] + [np.zeros(0, dtype=np.int64)])
+        np.savez_compressed(fname, **arrays)
+
+    def cor_graph(self, timeseries, attr=None, blocksize=None, thr=None,
+                  topk=None):
         """
         Takes timeseries and produces a correlation matrix
 
@@ -113,33 +228,58 @@ class graph(object):
             timeseries:
                 -the timeseries file to extract correlation for.
                           dimensions are [numrois]x[numtimesteps]
-        """
-        print("Estimating correlation matrix for {} ROIs...".format(self.N))
-        cor = np.corrcoef(timeseries)  # calculate pearson correlation
 
-        roilist = np.unique(self.rois)
-        roilist = roilist[roilist != 0]
-        roilist = np.sort(roilist)
-
-        for (idx_out, roi_out) in enumerate(roilist):
-            for (idx_in, roi_in) in enumerate(roilist):
-                self.edge_dict[tuple((roi_out, roi_in))] = float(np.absolute(
-                    cor[idx_out, idx_in]))
+        **Optional Arguments:**
+            blocksize:
+                - computes correlations in blocksize x blocksize tiles, so
+                  that the full matrix is never materialized
+            thr:
+                - keeps only edges with an absolute correlation of at
+                  least thr
+            topk:
+                - keeps only the topk strongest edges of each ROI
 
-        edge_list = [(k[0], k[1], v) for k, v in self.edge_dict.items()]
+        If any of these are given the graph has no self-loops; otherwise
+        every pair of ROIs, and every ROI with itself, gets an edge.
+        """
+        print("Estimating correlation matrix for {} ROIs...".format(self.N))
+        if blocksize is None and thr is None and topk is None:
+            cor = np.corrcoef(timeseries)  # calculate pearson correlation
+            u, v = np.triu_indices(len(cor))
+            w = np.absolute(cor[u, v])
+        else:
+            if blocksize is None:
+                blocksize = len(timeseries)
+            u, v, w = correlation_edges(timeseries, blocksize, thr, topk)
 
-        self.g.add_weighted_edges_from(edge_list)
+        self.g.add_weighted_edges_from(zip(self.n_ids[u].tolist(),
+                                           self.n_ids[v].tolist(),
+                                           w.tolist()))
         pass
 
     def get_graph(self):
         """
-        Returns the graph object created
+        Returns the graph object created, refreshing its edges if any were
+        counted, merged or subtracted since the last call
         """
         try:
-            return self.g
+            g = self.g
         except AttributeError:
             print("Error: the graph has not yet been defined.")
-            pass
+            return
+        if not self._synced:
+            volumes = np.bincount(self.lut[self.rois[self.rois != 0]
+                                           .astype(np.int64)],
+                                  minlength=len(self.n_ids))
+            u, v, layers = self.edges.layers(volumes)
+            names = sorted(layers)
+            attrs = [dict(zip(names, vals)) for vals in
+                     zip(*[layers[name].tolist() for name in names])]
+            g.remove_edges_from(list(g.edges()))
+            g.add_edges_from(zip(self.n_ids[u].tolist(),
+                                 self.n_ids[v].tolist(), attrs))
+            self._synced = True
+        return g
 
     def save_graph(self, graphname, fmt='edgelist'):
         """
@@ -153,8 +293,10 @@ class graph(object):
         **Optional Arguments:**
 
                 fmt:
-                    - Output graph format
+                    - Output graph format: 'edgelist', 'gpickle', 'graphml',
+                      or 'npz' (sparse adjacency, see write_npz_graph)
         """
+        self.get_graph()
         self.g.graph['ecount'] = nx.number_of_edges(self.g)
         g = nx.convert_node_labels_to_integers(self.g, first_label=1)
         if fmt == 'edgelist':
@@ -163,14 +305,1075 @@ class graph(object):
             nx.write_gpickle(g, graphname)
         elif fmt == 'graphml':
             nx.write_graphml(g, graphname)
+        elif fmt == 'npz':
+            write_npz_graph(self.g, graphname)
         else:
-            raise ValueError('edgelist, gpickle, and graphml currently supported')
+            raise ValueError('edgelist, gpickle, graphml, and npz currently '
+                             'supported')
         pass
 
+    def save_edge_index(self, fname):
+        """
+        Saves the streamlines that make up each edge, in CSR form. Streamline
+        IDs are positions in the tractogram the graph was built from.
+        Requires the graph to have been built with index=True.
+
+        **Positional Arguments:**
+
+                fname:
+                    - Filename for the .npz index (see edge_index)
+        """
+        u, v, indptr, sids = self.edges.member_index()
+        np.savez_compressed(fname, u=self.n_ids[u], v=self.n_ids[v],
+                            indptr=indptr, streamlines=sids)
+
+    def resample(self, nreps, method='bootstrap', fraction=1.0, seed=None,
+                 blocksize=None):
+        """
+        Generates connectomes from random subsets of the streamlines the
+        graph was built from, without re-graphing them. Requires the graph to
+        have been built with index=True.
+
+        **Positional Arguments:**
+
+                nreps:
+                    - Number of connectomes to generate
+
+        **Optional Arguments:**
+
+                method:
+                    - 'bootstrap' to draw streamlines with replacement, or
+                      'subsample' to draw them without replacement
+                fraction:
+                    - Number of streamlines drawn for each connectome, as a
+                      fraction of the tractogram
+                seed:
+                    - Seed of the random number generator
+                blocksize:
+                    - Number of connectomes computed at a time; by default
+                      as many as fit in 256MB (see resample_counts)
+
+        **Yields:**
+
+                NetworkX graph of each replicate, weighted by streamline count
+        """
+        u, v, indptr, sids = self.edges.member_index()
+        u, v = self.n_ids[u].tolist(), self.n_ids[v].tolist()
+        for counts in resample_counts(indptr, sids, self.edges.nlines, nreps,
+                                      method, fraction, seed, blocksize):
+            for col in counts.T:
+                g = nx.Graph(**self.g.graph)
+                g.add_nodes_from(self.n_ids.tolist())
+                keep = np.flatnonzero(col)
+                w = col.tolist()
+                g.add_weighted_edges_from((u[i], v[i], w[i]) for i in
+                                          keep.tolist())
+                g.graph['ecount'] = len(keep)
+                yield g
+
     def summary(self):
         """
         User friendly wrapping and display of graph properties
         """
         print("\n Graph Summary:")
-        print(nx.info(self.g))
+        print(nx.info(self.get_graph()))
         pass
+
+
+def streamline_lengths(points, offsets):
+    """
+    Computes the arc length of every streamline, in voxel units
+
+    **Positional Arguments:**
+
+            points:
+                - Flat point array, as returned by flatten_streamlines
+            offsets:
+                - Streamline offsets, as returned by flatten_streamlines
+    """
+    steps = np.sqrt((np.diff(points, axis=0) ** 2).sum(axis=1))
+    arc = np.zeros(len(points))
+    np.cumsum(steps, out=arc[1:])
+    lengths = np.zeros(len(offsets) - 1)
+    full = np.diff(offsets) > 0
+    lengths[full] = arc[offsets[1:][full] - 1] - arc[offsets[:-1][full]]
+    return lengths
+
+
+def voxelize(points):
+    """
+    Rounds streamline points to the nearest voxel
+
+    **Positional Arguments:**
+
+            points:
+                - [npoints]x3 array of coordinates in voxel space
+    """
+    return np.round(points).astype(np.intp)
+
+
+def compact_voxels(vox, offsets):
+    """
+    Drops consecutive repeats of the same voxel within each streamline and
+    stores the result as int16. A streamline's ROI set is unchanged, but the
+    number of label lookups shrinks several fold.
+
+    **Positional Arguments:**
+
+            vox:
+                - Flat voxel array, as returned by voxelize
+            offsets:
+                - Streamline offsets, as returned by flatten_streamlines
+
+    **Returns:**
+
+            vox, offsets of the deduplicated streamlines
+    """
+    keep = np.ones(len(vox), dtype=bool)
+    if len(vox):
+        keep[1:] = np.any(vox[1:] != vox[:-1], axis=1)
+        keep[offsets[:-1][np.diff(offsets) > 0]] = True
+    kept = np.zeros(len(vox) + 1, dtype=np.int64)
+    np.cumsum(keep, out=kept[1:])
+    lim = np.iinfo(np.int16)
+    vox = np.clip(vox[keep], lim.min, lim.max).astype(np.int16)
+    return vox, kept[offsets]
+
+
+def voxel_file(fibers):
+    """
+    Returns the name of the voxelized cache kept next to a fibers file
+    """
+    return "{}_voxels.npz".format(op.splitext(fibers)[0])
+
+
+def file_hash(fname, blocksize=2**20):
+    """
+    Returns the sha1 hex digest of a file's contents
+    """
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def save_voxels(streamlines, fibers, chunksize=100000):
+    """
+    Writes the voxelized tractogram cache for a fibers file: int16 voxel
+    coordinates with consecutive repeats removed, int64 streamline offsets,
+    float32 streamline lengths, int64 offsets of the streamlines' original
+    points, and the hash of the fibers file they were computed from. Streamlines are voxelized a chunk at a time and appended
+    to raw scratch files, which are packed into an uncompressed .npz, so
+    memory use does not grow with the tractogram.
+
+    **Positional Arguments:**
+
+            streamlines:
+                - Iterable of fiber streamlines in a dipy EuDX or compatible
+                  format, as stored in fibers
+            fibers:
+                - Fibers file the streamlines were saved to
+
+    **Optional Arguments:**
+
+            chunksize:
+                - Number of streamlines voxelized at a time
+
+    **Returns:**
+
+            vox, offsets, lengths, points as stored in the cache (see
+            read_voxels)
+    """
+    scratch = tempfile.mkdtemp(prefix='ndmg_voxels_')
+    try:
+        paths = [op.join(scratch, name) for name in
+                 ('vox.raw', 'counts.raw', 'lengths.raw', 'points.raw')]
+        npoints = 0
+        with open(paths[0], 'wb') as fvox, open(paths[1], 'wb') as fcount, \
+                open(paths[2], 'wb') as flen, open(paths[3], 'wb') as fpts:
+            for cvox, coff, clen, cpts in voxel_chunks(streamlines,
+                                                       chunksize):
+                np.ascontiguousarray(cvox, dtype=np.int16).tofile(fvox)
+                np.diff(coff).astype(np.int64).tofile(fcount)
+                np.asarray(clen, dtype=np.float32).tofile(flen)
+                np.diff(cpts).astype(np.int64).tofile(fpts)
+                npoints += len(cvox)
+        if npoints:
+            vox = np.memmap(paths[0], dtype=np.int16, mode='r',
+                            shape=(npoints, 3))
+        else:
+            vox = np.zeros((0, 3), dtype=np.int16)
+        offsets, points = [], []
+        for path, out in ((paths[1], offsets), (paths[3], points)):
+            counts = np.fromfile(path, dtype=np.int64)
+            out.append(np.zeros(len(counts) + 1, dtype=np.int64))
+            np.cumsum(counts, out=out[0][1:])
+        del counts
+        lengths = np.fromfile(paths[2], dtype=np.float32)
+        np.savez(voxel_file(fibers), vox=vox, offsets=offsets[0],
+                 lengths=lengths, points=points[0],
+                 source=file_hash(fibers))
+        del vox
+    finally:
+        shutil.rmtree(scratch)
+    return read_voxels(voxel_file(fibers))
+
+
+def read_voxels(cache):
+    """
+    Memory maps the arrays of a voxelized tractogram cache, so that chunks
+    split from them (see split_voxels) are read from disk as they are used
+
+    **Positional Arguments:**
+
+            cache:
+                - Voxelized cache, as written by save_voxels
+
+    **Returns:**
+
+            vox, offsets, lengths, points of the voxelized streamlines
+    """
+    voxels = np.load(cache)
+    arrays = []
+    for name in ('vox', 'offsets', 'lengths', 'points'):
+        mapped = mmap_npz(cache, name)
+        arrays.append(voxels[name] if mapped is None else mapped)
+    return tuple(arrays)
+
+
+def load_voxels(fibers):
+    """
+    Returns the voxelized streamlines of a fibers file, memory mapped from
+    the cache next to the file (see read_voxels). The cache is reused when
+    its hash matches the fibers; otherwise the fibers are read chunk by
+    chunk, voxelized, and the cache is (re)written.
+
+    **Positional Arguments:**
+
+            fibers:
+                - Fibers file produced by ndmg_dwi_pipeline
+
+    **Returns:**
+
+            vox, offsets, lengths, points of the voxelized streamlines
+    """
+    cache = voxel_file(fibers)
+    if op.isfile(cache):
+        voxels = np.load(cache)
+        if ('points' in voxels.files and
+                str(voxels['source']) == file_hash(fibers)):
+            print("Using voxelized fibers: {}".format(cache))
+            return read_voxels(cache)
+    print("Voxelizing fibers: {}".format(fibers))
+    return save_voxels(tractogram(fibers), fibers)
+
+
+def streamline_voxels(streamlines):
+    """
+    Returns the compact voxelized form of streamlines given either in memory
+    or as a fibers file, along with the streamline lengths
+
+    **Positional Arguments:**
+
+            streamlines:
+                - Fiber streamlines either file or array in a dipy EuDX
+                  or compatible format.
+
+    **Returns:**
+
+            vox, offsets:
+                - Voxels with consecutive repeats removed, and the
+                  streamline offsets into them (see compact_voxels)
+            lengths:
+                - Length of each streamline
+            points:
+                - Streamline offsets into the original points, as returned
+                  by flatten_streamlines
+    """
+    if isinstance(streamlines, str):
+        return load_voxels(streamlines)
+    points, offsets = flatten_streamlines(streamlines)
+    lengths = streamline_lengths(points, offsets)
+    vox, voffsets = compact_voxels(voxelize(points), offsets)
+    return vox, voffsets, lengths, offsets
+
+
+def lookup_rois(vox, rois):
+    """
+    Resolves the label under every voxel with a single gather. Any voxel
+    falling outside of the label volume is assigned to background (0).
+
+    **Positional Arguments:**
+
+            vox:
+                - [npoints]x3 integer voxel array, as returned by voxelize
+            rois:
+                - 3D label volume
+    """
+    inside = np.all((vox >= 0) & (vox < np.array(rois.shape[0:3])), axis=1)
+    labels = np.zeros(len(vox), dtype=np.int64)
+    vox = vox[inside]
+    labels[inside] = rois[vox[:, 0], vox[:, 1], vox[:, 2]]
+    return labels
+
+
+def segment_unique(sids, labels):
+    """
+    Computes the sorted set of unique non-zero labels within each segment
+
+    **Positional Arguments:**
+
+            sids:
+                - Non-decreasing segment (streamline) id of each label
+            labels:
+                - Integer label of each point
+
+    **Returns:**
+
+            sids, labels of the unique (segment, label) pairs, sorted by
+            segment and then by label.
+    """
+    keep = labels != 0
+    sids = sids[keep].astype(np.int64)
+    labels = labels[keep]
+    if len(labels) == 0:
+        return sids, labels
+    base = np.int64(labels.max()) + 1
+    keys = np.unique(sids * base + labels)
+    return keys // base, keys % base
+
+
+def streamline_ids(offsets):
+    """
+    Expands streamline offsets into the streamline id of every point
+
+    **Positional Arguments:**
+
+            offsets:
+                - Streamline offsets, as returned by flatten_streamlines
+    """
+    return np.repeat(np.arange(len(offsets) - 1, dtype=np.int64),
+                     np.diff(offsets))
+
+
+def streamline_rois(vox, offsets, rois):
+    """
+    Finds the set of ROIs each streamline passes through
+
+    **Positional Arguments:**
+
+            vox:
+                - Flat voxel array, as returned by voxelize
+            offsets:
+                - Streamline offsets, as returned by flatten_streamlines
+            rois:
+                - 3D label volume
+
+    **Returns:**
+
+            sids, labels as returned by segment_unique
+    """
+    return segment_unique(streamline_ids(offsets), lookup_rois(vox, rois))
+
+
+def roi_pairs(sids, rois, max_pairs=2**22):
+    """
+    Generates every (low, high) pair of ROIs visited by the same streamline.
+    Pairs are produced in bulk, in blocks of roughly max_pairs so that
+    streamlines crossing hundreds of ROIs do not exhaust memory; the pairs of
+    a single streamline are never split across blocks.
+
+    **Positional Arguments:**
+
+            sids:
+                - Streamline id of each ROI, as returned by segment_unique
+            rois:
+                - ROIs, sorted within each streamline
+
+    **Optional Arguments:**
+
+            max_pairs:
+                - Approximate number of pairs yielded per block
+
+    **Yields:**
+
+            sids, u, v arrays: the streamline and the two ROIs of each pair
+    """
+    n = len(rois)
+    ends = np.searchsorted(sids, sids, side='right')
+    npairs = ends - np.arange(n) - 1  # pairs formed with later ROIs
+    cum = np.cumsum(npairs)
+    start = 0
+    while start < n:
+        base = cum[start - 1] if start else 0
+        stop = np.searchsorted(cum, base + max_pairs, side='right')
+        if stop < n:
+            # back up to the first ROI of the streamline being cut
+            stop = np.searchsorted(sids, sids[stop], side='left')
+            if stop <= start:
+                stop = ends[start]
+        else:
+            stop = n
+        counts = npairs[start:stop]
+        left = np.repeat(np.arange(start, stop), counts)
+        firsts = np.cumsum(counts) - counts
+        right = left + 1 + np.arange(len(left)) - np.repeat(firsts, counts)
+        yield sids[left], rois[left], rois[right]
+        start = stop
+
+
+class edge_accumulator(object):
+    def __init__(self, n, members=False):
+        """
+        Sparse, array-backed edge counts between n nodes. Node pairs are
+        packed into int64 keys, reduced per batch, and summed into upper
+        triangular CSR matrices: the streamline count of each edge, and the
+        summed length and inverse length of those streamlines, from which
+        the weight layers are derived.
+
+        **Positional Arguments:**
+
+                n:
+                    - Number of nodes
+
+        **Optional Arguments:**
+
+                members:
+                    - Whether to also record which streamlines make up each
+                      edge (see member_index)
+        """
+        self.n = n
+        self.nlines = 0
+        self.counts = sparse.csr_matrix((n, n), dtype=np.int64)
+        self.lengths = sparse.csr_matrix((n, n), dtype=np.float64)
+        self.inv_lengths = sparse.csr_matrix((n, n), dtype=np.float64)
+        self.members = [] if members else None
+
+    def _sum(self, keys, inverse, weights):
+        return sparse.csr_matrix((np.bincount(inverse, weights=weights),
+                                  (keys // self.n, keys % self.n)),
+                                 shape=(self.n, self.n))
+
+    def _at(self, mat, u, v):
+        if len(u) == 0:
+            return np.zeros(0)
+        return np.asarray(mat[u, v]).ravel()
+
+    def add(self, u, v, lengths=None, sids=None):
+        """
+        Adds one streamline to each (u, v) edge
+
+        **Positional Arguments:**
+
+                u:
+                    - Node index of the first endpoint of each edge
+                v:
+                    - Node index of the second endpoint; must be above u
+
+        **Optional Arguments:**
+
+                lengths:
+                    - Length of the streamline behind each edge
+                sids:
+                    - ID of the streamline behind each edge, recorded when
+                      the accumulator tracks members
+        """
+        if len(u) == 0:
+            return
+        pairs = u.astype(np.int64) * self.n + v
+        if self.members is not None and sids is not None:
+            self.members.append((pairs, np.asarray(sids, dtype=np.int64)))
+        keys, inverse = np.unique(pairs, return_inverse=True)
+        self.counts = self.counts + self._sum(keys, inverse, None).astype(
+            np.int64)
+        if lengths is not None:
+            lengths = np.asarray(lengths, dtype=np.float64)
+            inv = np.zeros(len(lengths))
+            np.divide(1.0, lengths, out=inv, where=lengths > 0)
+            self.lengths = self.lengths + self._sum(keys, inverse, lengths)
+            self.inv_lengths = self.inv_lengths + self._sum(keys, inverse,
+                                                            inv)
+
+    def merge(self, other):
+        """
+        Adds the counts of another accumulator over the same nodes. The
+        other accumulator's streamlines are numbered after this one's.
+
+        **Positional Arguments:**
+
+                other:
+                    - edge_accumulator to add to this one
+        """
+        if self.members is not None:
+            if other.members is None:
+                raise ValueError("Cannot merge edges without recorded "
+                                 "members into an edge index")
+            self.members.extend((pairs, sids + self.nlines)
+                                for pairs, sids in other.members)
+        self.nlines += other.nlines
+        self.counts = self.counts + other.counts
+        self.lengths = self.lengths + other.lengths
+        self.inv_lengths = self.inv_lengths + other.inv_lengths
+
+    def subtract(self, other):
+        """
+        Removes the counts of another accumulator over the same nodes
+
+        **Positional Arguments:**
+
+                other:
+                    - edge_accumulator holding streamlines that were
+                      previously added to this one
+        """
+        counts = self.counts - other.counts
+        if counts.nnz and counts.data.min() < 0:
+            raise ValueError("Cannot subtract streamlines that were never "
+                             "added")
+        counts.eliminate_zeros()
+        # Drop the rounding residue of edges that no longer exist
+        keep = counts.astype(bool)
+        self.counts = counts
+        self.lengths = (self.lengths - other.lengths).multiply(keep).tocsr()
+        self.inv_lengths = (self.inv_lengths -
+                            other.inv_lengths).multiply(keep).tocsr()
+
+    def edge_list(self):
+        """
+        Returns the u, v and count arrays of every non-zero edge
+        """
+        coo = self.counts.tocoo()
+        return coo.row, coo.col, coo.data
+
+    def member_index(self):
+        """
+        Returns the streamlines that make up each edge, in CSR form
+
+        **Returns:**
+
+                u, v of every non-zero edge (in edge_list order), indptr, and
+                sids, such that the streamlines of edge i are
+                sids[indptr[i]:indptr[i + 1]] in increasing order
+        """
+        if self.members is None:
+            raise ValueError("Edge members were not recorded; build the "
+                             "graph with index=True")
+        u, v, _ = self.edge_list()
+        if self.members:
+            pairs = np.concatenate([m[0] for m in self.members])
+            sids = np.concatenate([m[1] for m in self.members])
+        else:
+            pairs = sids = np.zeros(0, dtype=np.int64)
+        order = np.lexsort((sids, pairs))
+        pairs, sids = pairs[order], sids[order]
+        keys = u.astype(np.int64) * self.n + v
+        indptr = np.append(np.searchsorted(pairs, keys), len(sids))
+        if self.nlines < 2 ** 31:
+            sids = sids.astype(np.int32)
+        return u, v, indptr, sids
+
+    def layers(self, volumes=None):
+        """
+        Derives the edge weight layers
+
+        **Optional Arguments:**
+
+                volumes:
+                    - Number of voxels in each node's ROI
+
+        **Returns:**
+
+                u, v of every non-zero edge, and a dictionary of weight arrays:
+                    - weight: streamline count
+                    - length_normalized: count divided by the mean length of
+                      the edge's streamlines
+                    - inverse_length: sum of the inverse streamline lengths
+                    - volume_normalized: count divided by the mean volume of
+                      the two ROIs (when volumes are given)
+        """
+        u, v, count = self.edge_list()
+        count = count.astype(np.float64)
+        mean_len = self._at(self.lengths, u, v) / count
+        norm = np.zeros(len(count))
+        np.divide(count, mean_len, out=norm, where=mean_len > 0)
+        layers = {'weight': count.astype(np.int64),
+                  'length_normalized': norm,
+                  'inverse_length': self._at(self.inv_lengths, u, v)}
+        if volumes is not None:
+            layers['volume_normalized'] = 2 * count / (volumes[u] +
+                                                       volumes[v])
+        return u, v, layers
+
+
+def count_edges(edges, vox, offsets, rois, lut, lengths=None):
+    """
+    Counts the ROI pairs of voxelized streamlines into an edge accumulator
+
+    **Positional Arguments:**
+
+            edges:
+                - edge_accumulator to add to
+            vox:
+                - Flat voxel array, as returned by voxelize
+            offsets:
+                - Streamline offsets, as returned by flatten_streamlines
+            rois:
+                - 3D label volume
+            lut:
+                - Array mapping each label to its node index
+
+    **Optional Arguments:**
+
+            lengths:
+                - Length of each streamline
+    """
+    sids, labels = streamline_rois(vox, offsets, rois)
+    for psids, u, v in roi_pairs(sids, lut[labels]):
+        edges.add(u, v, None if lengths is None else lengths[psids],
+                  psids + edges.nlines)
+    edges.nlines += len(offsets) - 1
+
+
+def _shard_edges(args):
+    """
+    Pool worker for parallel_edges: counts the edges of one streamline chunk
+    against every (memory mapped) label volume.
+    """
+    vox, offsets, lengths, points, volumes = args
+    shard = []
+    for path, lut, n, members in volumes:
+        edges = edge_accumulator(n, members)
+        count_edges(edges, vox, offsets, np.load(path, mmap_mode='r'), lut,
+                    lengths)
+        shard.append(edges)
+    return len(offsets) - 1, points[-1] - points[0], shard
+
+
+def split_voxels(vox, offsets, lengths, points, chunksize):
+    """
+    Splits voxelized streamlines into chunks of at most chunksize streamlines
+
+    **Positional Arguments:**
+
+            vox:
+                - Flat voxel array, as returned by voxelize
+            offsets:
+                - Streamline offsets into vox
+            lengths:
+                - Length of each streamline
+            points:
+                - Streamline offsets into the original points
+            chunksize:
+                - Number of streamlines per chunk
+
+    **Yields:**
+
+            vox, offsets, lengths, points of each chunk, with offsets and
+            points relative to the chunk
+    """
+    nlines = len(offsets) - 1
+    for start in range(0, nlines, chunksize):
+        stop = min(start + chunksize, nlines)
+        first, last = offsets[start], offsets[stop]
+        yield (vox[first:last], offsets[start:stop + 1] - first,
+               lengths[start:stop],
+               points[start:stop + 1] - points[start])
+
+
+def voxel_chunks(streamlines, chunksize):
+    """
+    Voxelizes streamlines from any iterable, including a generator, a batch
+    at a time, so that only one batch of points is ever held in memory
+
+    **Positional Arguments:**
+
+            streamlines:
+                - Iterable of [npoints]x3 streamline arrays, or a fibers
+                  file, which is split from its voxelized cache
+            chunksize:
+                - Number of streamlines per chunk
+
+    **Yields:**
+
+            vox, offsets, lengths, points of each chunk, as returned by
+            streamline_voxels
+    """
+    if isinstance(streamlines, str):
+        for chunk in split_voxels(*(load_voxels(streamlines) +
+                                    (chunksize,))):
+            yield chunk
+        return
+    streamlines = iter(streamlines)
+    while True:
+        batch = list(islice(streamlines, chunksize))
+        if not batch:
+            return
+        yield streamline_voxels(batch)
+
+
+def parallel_edges(graphs, chunks, nproc, progress=None):
+    """
+    Counts the edges of several graphs across a process pool. Streamline
+    chunks are handed to the workers as they are produced, with at most two
+    per worker in flight, while the read-only label volumes are written once
+    to a scratch directory and memory mapped by every worker rather than
+    pickled with each task. Per-chunk counts are reduced into each graph in
+    the order the chunks were produced.
+
+    **Positional Arguments:**
+
+            graphs:
+                - List of graph objects to add edges to
+            chunks:
+                - Iterable of (vox, offsets, lengths, points) streamline
+                  chunks, as yielded by split_voxels or voxel_chunks
+            nproc:
+                - Number of worker processes
+
+    **Optional Arguments:**
+
+            progress:
+                - ndmg.utils progress object, updated as chunks complete
+    """
+    def collect(result):
+        nlines, npoints, shard = result.get()
+        for g, edges in zip(graphs, shard):
+            g.edges.merge(edges)
+        if progress is not None:
+            progress.update(nlines, npoints,
+                            sum(g.edges.counts.nnz for g in graphs))
+
+    scratch = tempfile.mkdtemp(prefix='ndmg_graph_')
+    try:
+        volumes = []
+        for idx, g in enumerate(graphs):
+            path = op.join(scratch, 'rois_{}.npy'.format(idx))
+            np.save(path, g.rois)
+            volumes.append((path, g.lut, len(g.n_ids),
+                            g.edges.members is not None))
+
+        pool = Pool(nproc)
+        try:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_shard_edges,
+                                                (chunk + (volumes,),)))
+                if len(pending) >= 2 * nproc:
+                    collect(pending.popleft())
+            while pending:
+                collect(pending.popleft())
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        shutil.rmtree(scratch)
+    for g in graphs:
+        g._synced = False
+
+
+def fill_graphs(graphs, streamlines, nproc=1, chunksize=100000,
+                progress=None, index=False):
+    """
+    Adds the edges of a set of streamlines to several graphs. Streamlines are
+    voxelized once, and each graph then only costs a label gather. Edges are
+    counted incrementally, chunksize streamlines at a time, so streamlines
+    given as a generator are never held in memory all at once.
+
+    **Positional Arguments:**
+
+            graphs:
+                - List of graph objects to add edges to
+            streamlines:
+                - Fiber streamlines either file, array, or generator in a
+                  dipy EuDX or compatible format. Files are graphed from
+                  their voxelized cache (see load_voxels).
+
+    **Optional Arguments:**
+
+            nproc:
+                - Number of processes to shard the streamlines across
+            chunksize:
+                - Number of streamlines graphed at a time
+            progress:
+                - ndmg.utils progress object to report throughput to
+            index:
+                - Whether to record which streamlines make up each edge
+    """
+    for g in graphs:
+        if index and g.edges.members is None:
+            g.edges.members = []
+    if isinstance(streamlines, str):
+        voxels = load_voxels(streamlines)
+        total = len(voxels[1]) - 1
+    else:
+        total = len(streamlines) if hasattr(streamlines, '__len__') else None
+    if total is not None:
+        print("# of Streamlines: " + str(total))
+        if progress is not None and progress.total is None:
+            progress.total = total
+        if nproc > 1:
+            # Keep a few chunks per worker for load balancing
+            chunksize = min(chunksize, max(1, -(-total // (4 * nproc))))
+    if isinstance(streamlines, str):
+        chunks = split_voxels(*(voxels + (chunksize,)))
+    else:
+        chunks = voxel_chunks(streamlines, chunksize)
+
+    if nproc > 1:
+        parallel_edges(graphs, chunks, nproc, progress=progress)
+    else:
+        for cvox, coff, clen, cpts in chunks:
+            for g in graphs:
+                g.add_voxels(cvox, coff, clen)
+            if progress is not None:
+                progress.update(len(coff) - 1, cpts[-1],
+                                sum(g.edges.counts.nnz for g in graphs))
+    if progress is not None:
+        progress.finish()
+
+
+def correlation_edges(timeseries, blocksize, thr=None, topk=None):
+    """
+    Computes a sparsified absolute correlation graph tile by tile. Rows are
+    standardized once, so each blocksize x blocksize tile of the correlation
+    matrix is a single product; only the edges that survive the threshold
+    and/or top-k selection are kept.
+
+    **Positional Arguments:**
+
+            timeseries:
+                - [numrois]x[numtimesteps] array
+            blocksize:
+                - Number of ROIs per tile side
+
+    **Optional Arguments:**
+
+            thr:
+                - Minimum absolute correlation of a kept edge
+            topk:
+                - Number of strongest edges kept for each ROI. An edge is
+                  kept if it is among the topk of either of its ROIs.
+
+    **Returns:**
+
+            u, v (with u < v) and absolute correlation w of each kept edge.
+            ROIs with a constant timeseries are not connected to anything.
+    """
+    z = np.array(timeseries, dtype=np.float64)
+    z -= z.mean(axis=1)[:, None]
+    norm = np.sqrt((z ** 2).sum(axis=1))
+    flat = norm == 0
+    norm[flat] = np.inf
+    z /= norm[:, None]
+
+    n = len(z)
+    us, vs, ws = [], [], []
+    for i0 in range(0, n, blocksize):
+        zi = z[i0:i0 + blocksize]
+        rows = np.arange(i0, i0 + len(zi))
+        best_w = np.zeros((len(zi), 0))
+        best_j = np.zeros((len(zi), 0), dtype=np.int64)
+        # Without top-k, only tiles on or above the diagonal are needed
+        for j0 in range(0 if topk else i0, n, blocksize):
+            tile = np.absolute(zi.dot(z[j0:j0 + blocksize].T))
+            cols = np.arange(j0, j0 + tile.shape[1])
+            tile[flat[rows], :] = -1
+            tile[:, flat[cols]] = -1
+            if topk:
+                tile[rows[:, None] == cols[None, :]] = -1
+                best_w = np.hstack((best_w, tile))
+                best_j = np.hstack((best_j, np.tile(cols, (len(zi), 1))))
+                if best_w.shape[1] > topk:
+                    top = np.argpartition(-best_w, topk - 1, axis=1)[:, :topk]
+                    r = np.arange(len(zi))[:, None]
+                    best_w, best_j = best_w[r, top], best_j[r, top]
+            else:
+                tile[rows[:, None] >= cols[None, :]] = -1
+                r, c = np.nonzero(tile >= (0 if thr is None else thr))
+                us.append(rows[r])
+                vs.append(cols[c])
+                ws.append(tile[r, c])
+        if topk:
+            keep = best_w >= (0 if thr is None else thr)
+            us.append(np.repeat(rows, keep.sum(axis=1)))
+            vs.append(best_j[keep])
+            ws.append(best_w[keep])
+
+    if not us:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0))
+    u, v, w = np.concatenate(us), np.concatenate(vs), np.concatenate(ws)
+    u, v = np.minimum(u, v), np.maximum(u, v)
+    _, first = np.unique(u * n + v, return_index=True)
+    return u[first], v[first], w[first]
+
+
+def resample_counts(indptr, sids, nlines, nreps, method='bootstrap',
+                    fraction=1.0, seed=None, blocksize=None,
+                    budget=256 * 1024 ** 2):
+    """
+    Computes the edge counts of random subsets of a tractogram from its edge
+    index. Each block of replicates is one product of the sparse
+    edge x streamline membership matrix with a streamline x replicate matrix
+    of draw counts, which is filled one replicate at a time.
+
+    **Positional Arguments:**
+
+            indptr:
+                - Edge index pointers, as returned by member_index
+            sids:
+                - Streamline IDs of the edges, as returned by member_index
+            nlines:
+                - Number of streamlines in the tractogram
+            nreps:
+                - Number of replicates
+
+    **Optional Arguments:**
+
+            method:
+                - 'bootstrap' to draw streamlines with replacement, or
+                  'subsample' to draw them without replacement
+            fraction:
+                - Number of streamlines drawn per replicate, as a fraction of
+                  nlines
+            seed:
+                - Seed of the random number generator
+            blocksize:
+                - Number of replicates computed at a time; by default as
+                  many as fit in the budget
+            budget:
+                - Memory budget in bytes for the draw counts and edge counts
+                  of a block of replicates
+
+    **Yields:**
+
+            [nedges]x[replicates] count arrays, blocksize replicates at a time
+    """
+    if method not in ('bootstrap', 'subsample'):
+        raise ValueError("Unknown resampling method {}; bootstrap and "
+                         "subsample currently supported".format(method))
+    ndraws = int(round(fraction * nlines))
+    if method == 'subsample' and ndraws > nlines:
+        raise ValueError("Cannot subsample more streamlines than the "
+                         "tractogram contains")
+    members = sparse.csr_matrix((np.ones(len(sids), dtype=np.int32), sids,
+                                 indptr), shape=(len(indptr) - 1, nlines))
+    if blocksize is None:
+        # int32 draw counts per streamline and int64 counts per edge
+        blocksize = budget // (4 * nlines + 8 * (len(indptr) - 1) or 1)
+    blocksize = max(1, blocksize)
+    rng = np.random.RandomState(seed)
+    for r0 in range(0, nreps, blocksize):
+        nblock = min(blocksize, nreps - r0)
+        weights = np.zeros((nlines, nblock), dtype=np.int32)
+        for col in range(nblock):
+            if method == 'bootstrap':
+                weights[:, col] = np.bincount(rng.randint(0, nlines, ndraws),
+                                              minlength=nlines)
+            elif ndraws:
+                weights[rng.choice(nlines, ndraws, replace=False), col] = 1
+        yield np.asarray(members.dot(weights))
+
+
+def load_counts(fname):
+    """
+    Reads edge counts written by graph.save_counts
+
+    **Positional Arguments:**
+
+            fname:
+                - Filename of the .npz counts
+
+    **Returns:**
+
+            ROI labels of the nodes, and an edge_accumulator with the counts
+    """
+    arrays = np.load(fname)
+    n_ids = arrays['n_ids']
+    edges = edge_accumulator(len(n_ids), 'member_pairs' in arrays.files)
+    edges.nlines = int(arrays['nlines'])
+    for name in ('counts', 'lengths', 'inv_lengths'):
+        setattr(edges, name, sparse.csr_matrix(
+            (arrays[name + '_data'], arrays[name + '_indices'],
+             arrays[name + '_indptr']), shape=(len(n_ids), len(n_ids))))
+    if edges.members is not None:
+        edges.members.append((arrays['member_pairs'], arrays['member_sids']))
+    return n_ids, edges
+
+
+def make_graphs(streamlines, labels, sens="dwi", nproc=1, progress=None,
+                index=False):
+    """
+    Builds one graph per parcellation from a single pass over the streamlines.
+    Points are flattened and rounded to voxels once, and each parcellation
+    then only costs a label gather.
+
+    **Positional Arguments:**
+
+            streamlines:
+                - Fiber streamlines either file, array, or generator in a
+                  dipy EuDX or compatible format.
+            labels:
+                - List of parcellations, as arrays or niftii files
+
+    **Optional Arguments:**
+
+            sens:
+                - Sensor modality stored with each graph
+            nproc:
+                - Number of processes to shard the streamlines across
+            progress:
+                - ndmg.utils progress object to report throughput to
+            index:
+                - Whether to record which streamlines make up each edge
+
+    **Returns:**
+
+            List of graph objects, in the same order as labels
+    """
+    graphs = [graph(None, label, sens=sens) for label in labels]
+    fill_graphs(graphs, streamlines, nproc, progress=progress, index=index)
+    return graphs
+
+
+class edge_index(object):
+    def __init__(self, fname):
+        """
+        Reads an edge index written by graph.save_edge_index, for looking up
+        the streamlines of an edge without re-graphing the tractogram
+
+        **Positional Arguments:**
+
+                fname:
+                    - Filename of the .npz index
+        """
+        index = np.load(fname)
+        self.u = index['u']
+        self.v = index['v']
+        self.indptr = index['indptr']
+        self.sids = index['streamlines']
+        self.base = max(self.u.max(), self.v.max()) + 1 if len(self.u) else 1
+        self.keys = self.u.astype(np.int64) * self.base + self.v
+
+    def __len__(self):
+        return len(self.keys)
+
+    def streamlines(self, u, v):
+        """
+        Returns the IDs of the streamlines between ROIs u and v
+
+        **Positional Arguments:**
+
+                u:
+                    - Label of one ROI
+                v:
+                    - Label of the other ROI
+        """
+        u, v = min(u, v), max(u, v)
+        if v >= self.base:
+            return self.sids[:0]
+        pos = np.searchsorted(self.keys, u * self.base + v)
+        if pos == len(self.keys) or self.keys[pos] != u * self.base + v:
+            return self.sids[:0]
+        return self.sids[self.indptr[pos]:self.indptr[pos + 1]]
@@ -175,7 +175,7 @@ class register(object):
         cmd = "eddy_correct {} {} {}".format(dwi, corrected_dwi, idx)
         status = mgu.execute_cmd(cmd, verb=True)
 
-    def resample(self, base, ingested, template):
+    def resample(self, base, ingested, template, dtype=None):
         """
         Resamples the image such that images which have already been aligned
         in real coordinates also overlap in the image/voxel space.
@@ -187,14 +187,23 @@ class register(object):
                     - Name of image after alignment
                 template:
                     - Image that is the target of the alignment
+
+        **Optional Arguments**
+                dtype:
+                    - Data type to resample and save the image as
         """
         # Loads images
-        template_im = nb.load(template)
+        template_im = mgu.load_header(template)
         base_im = nb.load(base)
+        if dtype is not None:
+            base_im = nb.Nifti1Image(mgu.read_data(base_im, dtype),
+                                     affine=base_im.get_affine(),
+                                     header=base_im.get_header())
+            base_im.set_data_dtype(dtype)
         # Aligns images
         target_im = nl.resample_img(base_im,
                                     target_affine=template_im.get_affine(),
-                                    target_shape=template_im.get_data().shape,
+                                    target_shape=template_im.shape,
                                     interpolation="nearest")
         # Saves new image
         nb.save(target_im, ingested)
@@ -211,7 +220,7 @@ class register(object):
             template:
                 - the template image to align to.
         """
-        goal_res = int(nb.load(template).get_header().get_zooms()[0])
+        goal_res = int(mgu.load_header(template).get_header().get_zooms()[0])
         cmd = "flirt -in {} -ref {} -out {} -nosearch -applyisoxfm {}"
         cmd = cmd.format(base, template, res, goal_res)
         mgu.execute_cmd(cmd, verb=True)
@@ -273,7 +282,7 @@ class register(object):
         
         self.align(t1w_brain, atlas_brain, xfm_t1w2temp)
         # Only do FNIRT at 1mm or 2mm
-        if nb.load(atlas).get_data().shape in [(182, 218, 182), (91, 109, 91)]:
+        if mgu.load_header(atlas).shape in [(182, 218, 182), (91, 109, 91)]:
             warp_t1w2temp = mgu.name_tmps(outdir, func_name,
                                           "_warp_t1w2temp.nii.gz")
 
@@ -291,7 +300,7 @@ class register(object):
 
 
     def dwi2atlas(self, dwi, gtab, t1w, atlas,
-                  aligned_dwi, outdir, clean=False):
+                  aligned_dwi, outdir, clean=False, dtype=None):
         """
         Aligns two images and stores the transform between them
 
@@ -309,6 +318,13 @@ class register(object):
                     - Aligned output dwi image as a nifti image file
                 outdir:
                     - Directory for derivatives to be stored
+
+        **Optional Arguments:**
+
+                clean:
+                    - Whether to delete the intermediate files
+                dtype:
+                    - Data type to load and resample the volumes as
         """
         # Creates names for all intermediate files used
         dwi_name = mgu.get_filename(dwi)
@@ -327,8 +343,8 @@ class register(object):
         self.align_slices(dwi, dwi2, np.where(gtab.b0s_mask)[0][0])
 
         # Loads DTI image in as data and extracts B0 volume
-        dwi_im = nb.load(dwi2)
-        b0_im = mgu.get_b0(gtab, dwi_im.get_data())
+        dwi_im = mgu.load_header(dwi2)
+        b0_im = mgu.get_b0(gtab, dwi2, dtype)
 
         # Wraps B0 volume in new nifti image
         b0_head = dwi_im.get_header()
@@ -347,7 +363,7 @@ class register(object):
 
         # Applies combined transform to dwi image volume
         self.applyxfm(temp_aligned, atlas, xfm, temp_aligned2)
-        self.resample(temp_aligned2, aligned_dwi, atlas)
+        self.resample(temp_aligned2, aligned_dwi, atlas, dtype)
 
         if clean:
             cmd = "rm -f {} {} {} {} {}*".format(dwi2, temp_aligned, b0,
@@ -24,12 +24,12 @@ from datetime import datetime
 from subprocess import Popen, PIPE
 import os.path as op
 import nibabel as nb
-import ndmg.graph as mgg
+from ndmg.graph.graph import make_graphs
 import ndmg.utils as mgu
 import numpy as np
 
 
-def multigraphs(fibers, labels, outdir, gformat='gpickle'):
+def multigraphs(fibers, labels, outdir, gformat='gpickle', nproc=1):
     """
     Creates a brain graph from fiber streamlines
     """
@@ -48,17 +48,13 @@ def multigraphs(fibers, labels, outdir, gformat='gpickle'):
     print "Graphs of streamlines downsampled to given labels: " +\
           (", ".join([x for x in graphs]))
 
-    # Load fibers
-    print "Loading fibers..."
-    fiber_npz = np.load(fibers)
-    tracks = fiber_npz[fiber_npz.keys()[0]]
-
-    # Generate graphs from streamlines for each parcellation
-    for idx, label in enumerate(label_name):
-        print "Generating graph for " + label + " parcellation..."
-        labels_im = nb.load(labels[idx])
-        g1 = mgg(len(np.unique(labels_im.get_data()))-1, labels[idx])
-        g1.make_graph(tracks)
+    # Generate graphs from streamlines for all parcellations in one pass;
+    # the fibers are only reloaded if their voxelized cache is out of date
+    print "Generating graphs for " + str(len(labels)) + " parcellations..."
+    gs = make_graphs(fibers, labels, nproc=nproc,
+                     progress=mgu.progress(interval=60))
+    for idx, g1 in enumerate(gs):
+        print "Graph for " + label_name[idx] + " parcellation:"
         g1.summary()
         g1.save_graph(graphs[idx])
 
@@ -75,6 +71,8 @@ def main():
                         derivatives will be stored")
     parser.add_argument("labels", action="store", nargs="*", help="Nifti \
                         labels of regions of interest in atlas space")
+    parser.add_argument("-n", "--nproc", type=int, default=1,
+                        help="Number of processes to use for graph building")
     result = parser.parse_args()
 
     # Create output directory
@@ -84,7 +82,8 @@ def main():
     p = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
     p.communicate()
 
-    multigraphs(result.fibers, result.labels, result.outdir)
+    multigraphs(result.fibers, result.labels, result.outdir,
+                nproc=result.nproc)
 
 
 if __name__ == "__main__":
@@ -99,7 +99,7 @@ def get_atlas(atlas_dir, dwi=True):
 
 
 def session_level(inDir, outDir, subjs, sesh=None, debug=False,
-                      stc=None, dwi=True):
+                      stc=None, dwi=True, nproc=1):
     """
     Crawls the given BIDS organized directory for data pertaining to the given
     subject and session, and passes necessary files to ndmg_pipeline for
@@ -126,7 +126,8 @@ def session_level(inDir, outDir, subjs, sesh=None, debug=False,
             print("Bvec file: {}".format(bvec[i]))
 
             ndmg_dwi_pipeline(dwi[i], bval[i], bvec[i], anat[i], atlas,
-                              atlas_mask, labels, outDir, clean=(not debug))
+                              atlas_mask, labels, outDir, clean=(not debug),
+                              nproc=nproc)
 
 
 def group_level(inDir, outDir, dataset=None, atlas=None, minimal=False,
@@ -159,7 +160,7 @@ def group_level(inDir, outDir, dataset=None, atlas=None, minimal=False,
         fs = [op.join(tmp_in, fl)
               for root, dirs, files in os.walk(tmp_in)
               for fl in files
-              if fl.endswith(".graphml") or fl.endswith(".gpickle") or fl.endswith('edgelist')]
+              if fl.endswith((".graphml", ".gpickle", "edgelist", ".npz"))]
         tmp_out = op.join(outDir, label)
         mgu.execute_cmd("mkdir -p {}".format(tmp_out))
         try:
@@ -226,6 +227,8 @@ def main():
     parser.add_argument('--debug', action='store_true', help='flag to store '
                         'temp files along the path of processing.',
                         default=False)
+    parser.add_argument('--nproc', action='store', type=int, default=1,
+                        help='Number of processes to use for graph building.')
     result = parser.parse_args()
 
     inDir = result.bids_dir
@@ -237,6 +240,7 @@ def main():
     push = result.push_data
     level = result.analysis_level
     debug = result.debug
+    nproc = result.nproc
     
     minimal = result.minimal
     log = result.log
@@ -265,7 +269,7 @@ def main():
             else: 
                 s3_get_data(buck, remo, inDir, public=creds)
         modif = 'ndmg'
-        session_level(inDir, outDir, subj, sesh, debug)
+        session_level(inDir, outDir, subj, sesh, debug, nproc=nproc)
 
     elif level == 'group':
         if buck is not None and remo is not None:
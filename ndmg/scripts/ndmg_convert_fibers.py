@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+# Copyright 2016 NeuroData (http://neurodata.io)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# ndmg_convert_fibers.py
+
+from __future__ import print_function
+
+from argparse import ArgumentParser
+from ndmg.utils.fibers import convert_fibers, dtypes
+
+
+def main():
+    parser = ArgumentParser(description="Rewrites fiber streamlines saved by \
+                            older versions of ndmg_dwi_pipeline in the flat, \
+                            memory mappable format")
+    parser.add_argument("fibers", action="store", nargs="+", help="Fiber \
+                        streamline .npz files, converted in place")
+    parser.add_argument("-t", "--dtype", default='float32', choices=dtypes,
+                        help="Storage type of the streamline points")
+    result = parser.parse_args()
+
+    for fibers in result.fibers:
+        print("Converting: {}".format(fibers))
+        convert_fibers(fibers, dtype=result.dtype)
+
+
+if __name__ == "__main__":
+    main()
@@ -30,15 +30,16 @@ from ndmg.stats.qa_fibers import *
 import ndmg.utils as mgu
 import ndmg.register as mgr
 import ndmg.track as mgt
-import ndmg.graph as mgg
 import ndmg.preproc as mgp
+from ndmg.graph.graph import make_graphs, voxel_file
+from ndmg.utils.fibers import fiber_writer
 import numpy as np
-import nibabel as nb
 import os
 
 
 def ndmg_dwi_pipeline(dwi, bvals, bvecs, mprage, atlas, mask, labels, outdir,
-                  clean=False, fmt='edgelist'):
+                  clean=False, fmt='edgelist', nproc=1, index=False,
+                  dtype='float64', model='tensor'):
     """
     Creates a brain graph from MRI data
     """
@@ -46,9 +47,9 @@ def ndmg_dwi_pipeline(dwi, bvals, bvecs, mprage, atlas, mask, labels, outdir,
 
     # Create derivative output directories
     dwi_name = mgu.get_filename(dwi)
-    cmd = "mkdir -p {}/reg/dwi {}/tensors {}/fibers {}/graphs \
+    cmd = "mkdir -p {}/reg/dwi {}/tensors {}/peaks {}/fibers {}/graphs \
            {}/qa/tensors {}/qa/tensors {}/qa/fibers {}/qa/reg/dwi"
-    cmd = cmd.format(*([outdir] * 8))
+    cmd = cmd.format(*([outdir] * 9))
     mgu.execute_cmd(cmd)
 
     # Graphs are different because of multiple parcellations
@@ -63,10 +64,14 @@ def ndmg_dwi_pipeline(dwi, bvals, bvecs, mprage, atlas, mask, labels, outdir,
     # Create derivative output file names
     aligned_dwi = "{}/reg/dwi/{}_aligned.nii.gz".format(outdir, dwi_name)
     tensors = "{}/tensors/{}_tensors.npz".format(outdir, dwi_name)
+    peaks = "{}/peaks/{}_peaks.npz".format(outdir, dwi_name)
     fibers = "{}/fibers/{}_fibers.npz".format(outdir, dwi_name)
     print("This pipeline will produce the following derivatives...")
     print("DWI volume registered to atlas: {}".format(aligned_dwi))
-    print("Diffusion tensors in atlas space: {}".format(tensors))
+    if model == 'csd':
+        print("CSD peaks in atlas space: {}".format(peaks))
+    else:
+        print("Diffusion tensors in atlas space: {}".format(tensors))
     print("Fiber streamlines in atlas space: {}".format(fibers))
 
     # Again, graphs are different
@@ -74,55 +79,82 @@ def ndmg_dwi_pipeline(dwi, bvals, bvecs, mprage, atlas, mask, labels, outdir,
               for x in label_name]
     print("Graphs of streamlines downsampled to given labels: " +
           ", ".join([x for x in graphs]))
+    indices = ["{}/fibers/{}_{}_index.npz".format(outdir, dwi_name, x)
+               for x in label_name]
 
     # Creates gradient table from bvalues and bvectors
     print("Generating gradient table...")
     dwi1 = "{}/tmp/{}_t1.nii.gz".format(outdir, dwi_name)
     bvecs1 = "{}/tmp/{}_1.bvec".format(outdir, dwi_name)
     mgp.rescale_bvec(bvecs, bvecs1)
+    # float64 is nibabel's default precision; anything else is read directly
+    dtype = None if dtype == 'float64' else dtype
     gtab = mgu.load_bval_bvec_dwi(bvals, bvecs1, dwi, dwi1)
 
     # Align DWI volumes to Atlas
     print("Aligning volumes...")
-    mgr().dwi2atlas(dwi1, gtab, mprage, atlas, aligned_dwi, outdir, clean)
+    mgr().dwi2atlas(dwi1, gtab, mprage, atlas, aligned_dwi, outdir, clean,
+                    dtype=dtype)
     loc0 = np.where(gtab.b0s_mask)[0][0]
-    reg_mri_pngs(aligned_dwi, atlas, "{}/qa/reg/dwi/".format(outdir), loc=loc0)
+    reg_mri_pngs(aligned_dwi, atlas, "{}/qa/reg/dwi/".format(outdir), loc=loc0,
+                 dtype=dtype)
 
     print("Beginning tractography...")
-    # Compute tensors and track fiber streamlines
-    tens, tracks = mgt().eudx_basic(aligned_dwi, mask, gtab, stop_val=0.2)
-    tensor2fa(tens, tensors, aligned_dwi, "{}/tensors/".format(outdir),
-              "{}/qa/tensors/".format(outdir))
+    if model == 'csd':
+        # Extract CSD peaks and track fiber streamlines
+        pks, batches = mgt().csd_stream(aligned_dwi, mask, gtab, nproc=nproc,
+                                        dtype=dtype, peaks=peaks)
+    else:
+        # Compute tensors and track fiber streamlines
+        tens, batches = mgt().eudx_stream(aligned_dwi, mask, gtab,
+                                          stop_val=0.2, nproc=nproc,
+                                          budget=2 * 1024 ** 3, dtype=dtype,
+                                          tensors=tensors)
+        tensor2fa(tens, tensors, aligned_dwi, "{}/tensors/".format(outdir),
+                  "{}/qa/tensors/".format(outdir))
+
+    # Each batch of streamlines is saved and sampled for QA as it is tracked
+    writer = fiber_writer(fibers)
+    sample = fiber_reservoir(2000)
+
+    def tracked():
+        for batch in batches:
+            writer.write(batch)
+            sample.add(batch)
+            for fib in batch:
+                yield fib
+
+    # Generate graphs for all parcellations in one pass over the streamlines.
+    # Tracked batches are voxelized here and counted by their own pool of
+    # workers while the tracking workers run ahead.
+    print("Generating graphs for {} parcellations...".format(len(labels)))
+    gs = make_graphs(tracked(), labels, nproc=nproc,
+                     progress=mgu.progress(interval=60), index=index)
+    writer.close()
 
     # As we've only tested VTK plotting on MNI152 aligned data...
-    if nb.load(mask).get_data().shape == (182, 218, 182):
+    if mgu.load_header(mask).shape == (182, 218, 182):
         try:
-            visualize_fibs(tracks, fibers, mask,
-                           "{}/qa/fibers/".format(outdir), 0.02)
+            visualize_fibs(sample.fibers, fibers, mask,
+                           "{}/qa/fibers/".format(outdir), 0.02, 1000)
         except:
             print("Fiber QA failed - VTK for Python not configured properly.")
 
-    # And save them to disk
-    np.savez(tensors, tens)
-    np.savez(fibers, tracks)
-
-    # Generate graphs from streamlines for each parcellation
-    for idx, label in enumerate(label_name):
-        print("Generating graph for {} parcellation...".format(label))
-
-        labels_im = nb.load(labels[idx])
-        g1 = mgg(len(np.unique(labels_im.get_data()))-1, labels[idx])
-        g1.make_graph(tracks)
+    for idx, g1 in enumerate(gs):
+        print("Graph for {} parcellation:".format(label_name[idx]))
         g1.summary()
         g1.save_graph(graphs[idx], fmt=fmt)
+        if index:
+            g1.save_edge_index(indices[idx])
 
     print("Execution took: {}".format(datetime.now() - startTime))
 
     # Clean temp files
     if clean:
         print("Cleaning up intermediate files... ")
-        cmd = 'rm -f {} tmp/{}* {} {}'.format(tensors, dwi_name,
-                                               aligned_dwi, fibers)
+        cmd = 'rm -f {} {} tmp/{}* {} {} {}'.format(tensors, peaks, dwi_name,
+                                                     aligned_dwi, fibers,
+                                                     voxel_file(fibers))
         mgu.execute_cmd(cmd)
 
     print("Complete!")
@@ -145,8 +177,21 @@ def main():
     parser.add_argument("-c", "--clean", action="store_true", default=False,
                         help="Whether or not to delete intemediates")
     parser.add_argument("-f", "--fmt", default='edgelist',
-                        choices=['gpickle', 'graphml', 'edgelist'],
+                        choices=['gpickle', 'graphml', 'edgelist', 'npz'],
                         help="Determines graph output format")
+    parser.add_argument("-n", "--nproc", type=int, default=1,
+                        help="Number of processes to use for tracking and \
+                        graph building")
+    parser.add_argument("--index", action="store_true", default=False,
+                        help="Whether to save the streamlines of each edge \
+                        alongside the fibers")
+    parser.add_argument("-d", "--dtype", default='float64',
+                        choices=['float64', 'float32'], help="Precision to \
+                        load, resample and fit the DWI volumes in")
+    parser.add_argument("-m", "--model", default='tensor',
+                        choices=['tensor', 'csd'], help="Diffusion model to \
+                        track: tensors, or constrained spherical \
+                        deconvolution peaks")
     result = parser.parse_args()
 
     # Create output directory
@@ -158,7 +203,8 @@ def main():
 
     ndmg_dwi_pipeline(result.dwi, result.bval, result.bvec, result.mprage,
                       result.atlas, result.mask, result.labels, result.outdir,
-                      result.clean, result.fmt)
+                      result.clean, result.fmt, result.nproc, result.index,
+                      result.dtype, result.model)
 
 
 if __name__ == "__main__":
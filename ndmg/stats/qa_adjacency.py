@@ -21,6 +21,7 @@
 
 import os
 import networkx as nx
+from ndmg.utils import loadGraphs
 import matplotlib
 import numpy as np
 from argparse import ArgumentParser
@@ -31,14 +32,10 @@ import matplotlib.pyplot as plt
 
 def graph2png(infile, outdir, fname=None):
     '''
-    infile: input .gpickle or .graphml file
+    infile: input .gpickle, .graphml, .edgelist or .npz file
     outdir: path to directory to store output png files
     '''
-    # if file is .gpickle, otherwise load .graphml
-    try:
-        graph = nx.read_gpickle(infile)
-    except:
-        graph = nx.read_graphml(infile)
+    graph = list(loadGraphs(infile).values())[0]
     # get numpy array equivalent of adjacency matrix
     g = nx.adj_matrix(graph).todense()
     fig = plt.figure(figsize=(7, 7))
@@ -117,6 +117,34 @@ def random_sample(fibs, num_samples):
     return [fibs[i] for i in samples]
 
 
+class fiber_reservoir(object):
+    def __init__(self, num_samples, seed=None):
+        '''
+        Keeps a uniform random sample of fibers from a stream of fiber
+        batches, without holding on to the whole stream
+        num_samples: number of fibers to keep
+        seed: seed of the random number generator
+        '''
+        self.num_samples = num_samples
+        self.fibers = []
+        self.seen = 0
+        self.rng = np.random.RandomState(seed)
+
+    def add(self, fibs):
+        '''
+        fibs: batch of fibers, each as 2D array (N,3)
+        '''
+        # Reservoir sampling: fiber t replaces a random kept fiber with
+        # probability num_samples / (t + 1)
+        fill = min(len(fibs), max(0, self.num_samples - len(self.fibers)))
+        self.fibers.extend(fibs[:fill])
+        t = self.seen + np.arange(fill, len(fibs))
+        slots = self.rng.randint(0, t + 1) if len(t) else t
+        for i in np.flatnonzero(slots < self.num_samples):
+            self.fibers[slots[i]] = fibs[fill + i]
+        self.seen += len(fibs)
+
+
 def load_atlas(path, opacity):
     '''
     path: path to atlas file
@@ -24,7 +24,6 @@ import os
 import re
 import sys
 import numpy as np
-import nibabel as nb
 import ndmg.utils as mgu
 from argparse import ArgumentParser
 from scipy import ndimage
@@ -35,21 +34,27 @@ mpl.use('Agg')  # very important above pyplot import
 import matplotlib.pyplot as plt
 
 
-def reg_mri_pngs(mri, atlas, outdir, loc=0, mean=False, dim=4):
+def reg_mri_pngs(mri, atlas, outdir, loc=0, mean=False, dim=4, dtype=None):
     """
     outdir: directory where output png file is saved
     fname: name of output file WITHOUT FULL PATH. Path provided in outdir.
+    dtype: data type to load the images as
     """
 
-    atlas_data = nb.load(atlas).get_data()
-    mri_data = nb.load(mri).get_data()
+    atlas_data = mgu.load_data(atlas, dtype)
     if dim==4:  # 4d data, so we need to reduce a dimension
+        # read one volume at a time rather than the whole series
         if mean:
-            b0_data = mri_data.mean(axis=3)
+            b0_data = 0
+            for nvol, vol in enumerate(mgu.iter_volumes(mri, dtype)):
+                if nvol == 0:
+                    b0_data = np.zeros(vol.shape, dtype=dtype or np.float64)
+                b0_data += vol
+            b0_data /= nvol + 1
         else:
-            b0_data = mri_data[:,:,:,loc]
+            b0_data = mgu.read_volume(mri, loc, dtype)
     else:  # dim=3
-        b0_data = mri_data
+        b0_data = mgu.load_data(mri, dtype)
 
     cmap1 = LinearSegmentedColormap.from_list('mycmap1', ['black', 'magenta'])
     cmap2 = LinearSegmentedColormap.from_list('mycmap2', ['black', 'green'])
@@ -27,6 +27,7 @@ import os
 import re
 import numpy as np
 import nibabel as nb
+import ndmg.utils as mgu
 import sys
 import matplotlib
 
@@ -40,9 +41,7 @@ def tensor2fa(tensors, tensor_name, dwi, derivdir, qcdir):
     fname: name of output fa map file. default is none (name created based on
     input file)
     '''
-    dwi_data = nb.load(dwi)
-    affine = dwi_data.get_affine()
-    dwi_data = dwi_data.get_data()
+    affine = mgu.load_header(dwi).get_affine()
 
     # create FA map
     FA = fractional_anisotropy(tensors.evals)
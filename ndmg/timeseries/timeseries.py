@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+# Copyright 2016 NeuroData (http://neurodata.io)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# timeseries.py
+
+from __future__ import print_function
+
+import numpy as np
+import ndmg.utils as mgu
+
+
+class timeseries(object):
+
+    def __init__(self):
+        """
+        Extracts ROI timeseries from atlas-aligned functional data, in the
+        [numrois]x[numtimesteps] layout expected by graph.cor_graph.
+        """
+        pass
+
+    def roi_timeseries(self, fmri_file, label_files, method='mean',
+                       chunksize=16):
+        """
+        Computes the timeseries of every ROI in one or more parcellations.
+        The 4D image is read through its (memory mapped, when uncompressed)
+        data proxy chunksize volumes at a time, so a long run is never fully
+        loaded into float64 memory.
+
+        **Positional Arguments:**
+
+                fmri_file:
+                    - 4D functional image aligned to the atlas (as produced
+                      by register.func2atlas)
+                label_files:
+                    - Parcellation, or list of parcellations, in atlas space,
+                      as arrays or niftii files
+
+        **Optional Arguments:**
+
+                method:
+                    - 'mean', 'median' or 'pca' (first principal component)
+                      of the voxel timeseries in each ROI
+                chunksize:
+                    - Number of volumes read at a time
+
+        **Returns:**
+
+                [numrois]x[numtimesteps] array per parcellation (a list if
+                label_files is a list). Rows follow the sorted non-zero
+                labels, which is the node order used by graph.
+        """
+        if method not in ('mean', 'median', 'pca'):
+            raise ValueError('mean, median, and pca currently supported')
+        single = not isinstance(label_files, list)
+        if single:
+            label_files = [label_files]
+
+        img = mgu.load_header(fmri_file)
+        shape = img.shape
+        indices = []
+        for label in label_files:
+            if isinstance(label, np.ndarray):
+                rois = label
+            else:
+                rois = mgu.load_data(label)
+            if rois.shape[0:3] != shape[0:3]:
+                raise ValueError("Labels of shape {} do not match the "
+                                 "functional image of shape {}"
+                                 .format(rois.shape, shape))
+            indices.append(label_index(rois))
+
+        ntime = shape[3]
+        ts = [np.zeros((len(idx[0]), ntime)) for idx in indices]
+        if method == 'pca':
+            voxts = [np.zeros((len(idx[2]), ntime), dtype=np.float32)
+                     for idx in indices]
+
+        print("Extracting ROI timeseries from {} volumes...".format(ntime))
+        for t0 in range(0, ntime, chunksize):
+            t1 = min(t0 + chunksize, ntime)
+            chunk = np.asarray(img.dataobj[..., t0:t1], dtype=np.float32)
+            chunk = chunk.reshape(shape[0:3] + (t1 - t0,))
+            for k, (ids, vox, lab, counts) in enumerate(indices):
+                vals = chunk[vox[0], vox[1], vox[2], :]
+                if method == 'mean':
+                    ts[k][:, t0:t1] = roi_means(vals, lab, counts)
+                elif method == 'median':
+                    ts[k][:, t0:t1] = roi_medians(vals, lab, counts)
+                else:
+                    voxts[k][:, t0:t1] = vals
+
+        if method == 'pca':
+            for k, (ids, vox, lab, counts) in enumerate(indices):
+                ts[k] = roi_pcas(voxts[k], lab, counts)
+        return ts[0] if single else ts
+
+
+def label_index(rois):
+    """
+    Precomputes the voxels belonging to each ROI of a parcellation
+
+    **Positional Arguments:**
+
+            rois:
+                - 3D label volume
+
+    **Returns:**
+
+            ids:
+                - Sorted non-zero labels
+            vox:
+                - Tuple of x, y, z coordinates of every labelled voxel,
+                  grouped by ROI
+            lab:
+                - ROI index (position in ids) of each labelled voxel
+            counts:
+                - Number of voxels in each ROI
+    """
+    rois = np.asarray(rois)
+    ids, inverse = np.unique(rois, return_inverse=True)
+    inverse = inverse.reshape(rois.shape)
+    nonzero = ids != 0
+    # shift indices so that they count non-zero labels only
+    shift = np.cumsum(~nonzero)
+    ids = ids[nonzero]
+    vox = np.nonzero(rois)
+    lab = inverse[vox] - shift[inverse[vox]]
+    order = np.argsort(lab, kind='mergesort')
+    vox = tuple(v[order] for v in vox)
+    lab = lab[order]
+    return ids, vox, lab, np.bincount(lab, minlength=len(ids))
+
+
+def roi_means(vals, lab, counts):
+    """
+    Averages voxel timeseries within each ROI with a single bincount
+
+    **Positional Arguments:**
+
+            vals:
+                - [numvoxels]x[numtimesteps] array of labelled voxels
+            lab:
+                - ROI index of each voxel, from label_index
+            counts:
+                - Number of voxels in each ROI
+    """
+    nroi, ntime = len(counts), vals.shape[1]
+    bins = lab[:, None] + nroi * np.arange(ntime)[None, :]
+    sums = np.bincount(bins.ravel(), weights=vals.ravel(),
+                       minlength=nroi * ntime)
+    return sums.reshape(ntime, nroi).T / counts[:, None]
+
+
+def roi_medians(vals, lab, counts):
+    """
+    Takes the median voxel timeseries within each ROI
+
+    **Positional Arguments:**
+
+            vals:
+                - [numvoxels]x[numtimesteps] array of voxels grouped by ROI
+            lab:
+                - ROI index of each voxel, from label_index
+            counts:
+                - Number of voxels in each ROI
+    """
+    bounds = np.cumsum(counts)[:-1]
+    return np.array([np.median(v, axis=0) for v in np.split(vals, bounds)])
+
+
+def roi_pcas(vals, lab, counts):
+    """
+    Takes the first principal component of the voxel timeseries within each
+    ROI, signed to agree with the ROI's mean timeseries
+
+    **Positional Arguments:**
+
+            vals:
+                - [numvoxels]x[numtimesteps] array of voxels grouped by ROI
+            lab:
+                - ROI index of each voxel, from label_index
+            counts:
+                - Number of voxels in each ROI
+    """
+    bounds = np.cumsum(counts)[:-1]
+    pcs = np.zeros((len(counts), vals.shape[1]))
+    for idx, v in enumerate(np.split(vals, bounds)):
+        v = v.astype(np.float64)
+        mean = v.mean(axis=0)
+        v -= v.mean(axis=1)[:, None]
+        _, s, vt = np.linalg.svd(v, full_matrices=False)
+        pc = vt[0] * s[0] / np.sqrt(len(v))
+        centered = mean - mean.mean()
+        pcs[idx] = -pc if np.dot(pc, centered) < 0 else pc
+    return pcs
@@ -20,9 +20,18 @@
 
 from __future__ import print_function
 
+from multiprocessing import Pool
+from collections import deque
+from itertools import islice
 import numpy as np
-import nibabel as nb
-from dipy.reconst.dti import TensorModel, fractional_anisotropy, quantize_evecs
+import ndmg.utils as mgu
+from ndmg.utils.fibers import mmap_npz
+import os.path as op
+import tempfile
+import hashlib
+import shutil
+from dipy.reconst.dti import (TensorModel, TensorFit, fractional_anisotropy,
+                              quantize_evecs)
 from dipy.reconst.csdeconv import (ConstrainedSphericalDeconvModel,
                                    auto_response)
 from dipy.direction import peaks_from_model
@@ -39,7 +48,8 @@ class track():
         # WGR:TODO rewrite help text
         pass
 
-    def eudx_basic(self, dwi_file, mask_file, gtab, stop_val=0.1):
+    def eudx_basic(self, dwi_file, mask_file, gtab, stop_val=0.1, nproc=1,
+                   budget=None, margin=2, dtype=None):
         """
         Tracking with basic tensors and basic eudx - experimental
         We now force seeding at every voxel in the provided mask for
@@ -56,24 +66,705 @@ class track():
         **Optional Arguments:**
                 stop_val:
                     - Value to cutoff fiber track
+                nproc:
+                    - Number of processes to track the seeds across. The
+                      streamlines are identical to those of a serial run.
+                budget:
+                    - Memory budget in bytes for fitting the tensors slab by
+                      slab (see fit_tensors); by default the volume is fit
+                      at once
+                margin:
+                    - Number of voxels kept around the mask's bounding box,
+                      to which the volume is cropped before fitting and
+                      tracking
+                dtype:
+                    - Data type to fit the tensors in, such as 'float32'
         """
+        ten, batches = self.eudx_stream(dwi_file, mask_file, gtab, stop_val,
+                                        nproc, budget=budget, margin=margin,
+                                        dtype=dtype)
+        tracks = [e for batch in batches for e in batch]
+        return (ten, tracks)
+
+    def eudx_stream(self, dwi_file, mask_file, gtab, stop_val=0.1, nproc=1,
+                    batchsize=10000, budget=None, margin=2, dtype=None,
+                    tensors=None):
+        """
+        Fits tensors like eudx_basic, but returns the streamlines as a
+        generator of batches that are tracked as they are consumed, so that
+        they never need to be held in memory all at once
+        **Positional Arguments:**
+
+                dwi_file:
+                    - File (registered) to use for tensor/fiber tracking
+                mask_file:
+                    - Brain mask to keep tensors inside the brain
+                gtab:
+                    - dipy formatted bval/bvec Structure
 
-        img = nb.load(dwi_file)
-        data = img.get_data()
+        **Optional Arguments:**
+                stop_val:
+                    - Value to cutoff fiber track
+                nproc:
+                    - Number of processes to track the seeds across. Workers
+                      keep tracking ahead while batches are consumed.
+                batchsize:
+                    - Number of seeds (in parallel) or streamlines (serially)
+                      per batch
+                budget:
+                    - Memory budget in bytes for fitting the tensors slab by
+                      slab (see fit_tensors); by default the volume is fit
+                      at once
+                margin:
+                    - Number of voxels kept around the mask's bounding box,
+                      to which the volume is cropped before fitting and
+                      tracking
+                dtype:
+                    - Data type to fit the tensors in, such as 'float32'
+                tensors:
+                    - Tensor file (see save_tensors). If it was saved from
+                      the same inputs (see input_key), the tensors are read
+                      from it rather than fit; otherwise the fit is saved
+                      to it.
 
-        img = nb.load(mask_file)
+        **Returns:**
 
-        mask = img.get_data()
+                The tensor fit (or tensor_file), and a generator of lists of
+                streamlines in seed order
+        """
+        full_mask = mgu.load_data(mask_file)
+        # Fit and track within the mask's bounding box only
+        crop = mask_bounds(full_mask, margin)
+        mask = full_mask[crop]
 
         # use all points in mask
         seedIdx = np.where(mask > 0)  # seed everywhere not equal to zero
         seedIdx = np.transpose(seedIdx)
 
-        model = TensorModel(gtab)
-        ten = model.fit(data, mask)
+        key = None
+        if tensors is not None:
+            key = input_key(dwi_file, full_mask, gtab, 'tensor', dtype)
+        if key is not None and saved_key(tensors) == key:
+            print("Using saved tensors: {}".format(tensors))
+            ten = tensor_file(tensors)
+            fa, evecs = ten.fa[crop], ten.evecs[crop]
+        else:
+            model = TensorModel(gtab)
+            if budget is None:
+                data = mgu.load_header(dwi_file).dataobj[crop]
+                if dtype is not None:
+                    # nibabel scales integer images to float64 itself; only
+                    # the cropped volume is held at that precision
+                    data = data.astype(dtype)
+                cten = model.fit(data, mask)
+            else:
+                # Slabs are fit from a scratch copy of the cropped image
+                cten = fit_tensors(model, dwi_file, mask, budget, nproc,
+                                   crop=crop, dtype=dtype)
+            fa, evecs = cten.fa, cten.evecs
+
+            # Keep the tensors on the full grid, as float32 like fit_tensors
+            params = np.zeros(full_mask.shape + (12,), dtype=np.float32)
+            params[crop] = cten.model_params
+            ten = TensorFit(model, params)
+            if tensors is not None:
+                save_tensors(ten, tensors, full_mask, key)
+                # Track from the saved tensors, as reruns do, so that both
+                # give the same streamlines
+                ten = tensor_file(tensors)
+                fa, evecs = ten.fa[crop], ten.evecs[crop]
+
         sphere = get_sphere('symmetric724')
-        ind = quantize_evecs(ten.evecs, sphere.vertices)
-        eu = EuDX(a=ten.fa, ind=ind, seeds=seedIdx,
-                  odf_vertices=sphere.vertices, a_low=stop_val)
-        tracks = [e for e in eu]
-        return (ten, tracks)
+        ind = quantize_evecs(evecs, sphere.vertices)
+        if nproc > 1:
+            batches = parallel_eudx(fa, ind, seedIdx, sphere.vertices,
+                                    stop_val, nproc, batchsize)
+        else:
+            eu = iter(EuDX(a=fa, ind=ind, seeds=seedIdx,
+                           odf_vertices=sphere.vertices, a_low=stop_val))
+            batches = iter(lambda: list(islice(eu, batchsize)), [])
+
+        # Return streamlines in the voxel coordinates of the full grid
+        offset = np.array([c.start for c in crop])
+        return (ten, shift_batches(batches, offset))
+
+    def csd_basic(self, dwi_file, mask_file, gtab, stop_val=0.1, nproc=1,
+                  margin=2, dtype=None, peaks=None):
+        """
+        Tracking with constrained spherical deconvolution peaks and basic
+        eudx, seeding at every voxel in the provided mask (see csd_stream)
+        **Positional Arguments:**
+
+                dwi_file:
+                    - File (registered) to use for fiber tracking
+                mask_file:
+                    - Brain mask to keep the peaks inside the brain
+                gtab:
+                    - dipy formatted bval/bvec Structure
+
+        **Optional Arguments:**
+                stop_val:
+                    - Peak value at which to cutoff fiber track
+                nproc:
+                    - Number of processes to extract peaks and track with
+                margin:
+                    - Number of voxels kept around the mask's bounding box
+                dtype:
+                    - Data type to read the DWI volumes as
+                peaks:
+                    - Peaks file (see save_peaks)
+        """
+        pks, batches = self.csd_stream(dwi_file, mask_file, gtab, stop_val,
+                                       nproc, margin=margin, dtype=dtype,
+                                       peaks=peaks)
+        tracks = [e for batch in batches for e in batch]
+        return (pks, tracks)
+
+    def csd_stream(self, dwi_file, mask_file, gtab, stop_val=0.1, nproc=1,
+                   batchsize=10000, margin=2, dtype=None, peaks=None):
+        """
+        Estimates a response function from the data, extracts the peaks of
+        the constrained spherical deconvolution fit within the mask, and
+        tracks them with EuDX. Streamlines are returned as a generator of
+        batches, as in eudx_stream.
+        **Positional Arguments:**
+
+                dwi_file:
+                    - File (registered) to use for fiber tracking
+                mask_file:
+                    - Brain mask to keep the peaks inside the brain
+                gtab:
+                    - dipy formatted bval/bvec Structure
+
+        **Optional Arguments:**
+                stop_val:
+                    - Peak value at which to cutoff fiber track
+                nproc:
+                    - Number of processes to extract peaks (in dipy's
+                      parallel mode) and track the seeds across
+                batchsize:
+                    - Number of seeds (in parallel) or streamlines (serially)
+                      per batch
+                margin:
+                    - Number of voxels kept around the mask's bounding box,
+                      to which the volume is cropped before fitting and
+                      tracking
+                dtype:
+                    - Data type to read the DWI volumes as, such as 'float32'
+                peaks:
+                    - Peaks file (see save_peaks). If it was saved from the
+                      same inputs and settings (see input_key), the peaks
+                      are read from it rather than extracted; otherwise the
+                      peaks are saved to it.
+
+        **Returns:**
+
+                The peak values and indices within the mask's bounding box,
+                and a generator of lists of streamlines in seed order
+        """
+        full_mask = mgu.load_data(mask_file)
+        crop = mask_bounds(full_mask, margin)
+        mask = full_mask[crop]
+
+        # use all points in mask
+        seedIdx = np.where(mask > 0)  # seed everywhere not equal to zero
+        seedIdx = np.transpose(seedIdx)
+
+        # Response, sphere and peak settings, which the saved peaks are
+        # keyed on along with the inputs
+        sphere_name, roi_radius, fa_thr = 'symmetric724', 10, 0.7
+        rel_thr, min_angle = .5, 25
+        sphere = get_sphere(sphere_name)
+        pks, key = None, None
+        if peaks is not None:
+            key = input_key(dwi_file, full_mask, gtab, 'csd', margin, dtype,
+                            sphere_name, roi_radius, fa_thr, rel_thr,
+                            min_angle)
+        if key is not None and saved_key(peaks) == key:
+            print("Using saved peaks: {}".format(peaks))
+            pks = load_peaks(peaks)
+        if pks is None:
+            data = mgu.load_header(dwi_file).dataobj[crop]
+            if dtype is not None:
+                data = data.astype(dtype)
+            response, ratio = auto_response(gtab, data, roi_radius=roi_radius,
+                                            fa_thr=fa_thr)
+            model = ConstrainedSphericalDeconvModel(gtab, response)
+            fit = peaks_from_model(model=model, data=data, sphere=sphere,
+                                   relative_peak_threshold=rel_thr,
+                                   min_separation_angle=min_angle, mask=mask,
+                                   return_sh=False, parallel=nproc > 1,
+                                   nbr_processes=nproc)
+            # Stored as float32; track from the stored values so reruns
+            # give the same streamlines
+            pks = (fit.peak_values.astype(np.float32),
+                   fit.peak_indices.astype(np.int32))
+            del fit, data
+            if peaks is not None:
+                save_peaks(pks, peaks, key)
+
+        values, indices = pks
+        if nproc > 1:
+            batches = parallel_eudx(values, indices, seedIdx,
+                                    sphere.vertices, stop_val, nproc,
+                                    batchsize)
+        else:
+            eu = iter(EuDX(a=values, ind=indices, seeds=seedIdx,
+                           odf_vertices=sphere.vertices, a_low=stop_val))
+            batches = iter(lambda: list(islice(eu, batchsize)), [])
+
+        # Return streamlines in the voxel coordinates of the full grid
+        offset = np.array([c.start for c in crop])
+        return (pks, shift_batches(batches, offset))
+
+
+def save_peaks(pks, fname, key=None):
+    """
+    Saves the peaks extracted by csd_stream in an .npz
+
+    **Positional Arguments:**
+
+            pks:
+                - Tuple of peak values and peak indices within the mask's
+                  bounding box
+            fname:
+                - Filename for the .npz
+
+    **Optional Arguments:**
+
+            key:
+                - Key of the peaks' inputs, as returned by input_key
+    """
+    arrays = dict(values=pks[0], indices=pks[1])
+    if key is not None:
+        arrays['source'] = key
+    np.savez(fname, **arrays)
+
+
+def load_peaks(fname):
+    """
+    Reads peaks written by save_peaks, as a tuple of peak values and peak
+    indices
+    """
+    npz = np.load(fname)
+    return (npz['values'], npz['indices'])
+
+
+def input_key(dwi_file, mask, gtab, *settings):
+    """
+    Returns a sha1 hex digest identifying the inputs of a fit: the DWI
+    image's contents (see ndmg.utils.image_hash), the mask, the gradient
+    table, and any settings given
+
+    **Positional Arguments:**
+
+            dwi_file:
+                - DWI image file
+            mask:
+                - 3D brain mask
+            gtab:
+                - dipy formatted bval/bvec Structure
+            settings:
+                - Other parameters of the fit, compared by their repr
+    """
+    mask = np.asarray(mask) > 0
+    sha = hashlib.sha1(mgu.image_hash(dwi_file).encode('utf-8'))
+    sha.update(repr(mask.shape).encode('utf-8'))
+    sha.update(np.packbits(mask).tobytes())
+    sha.update(np.asarray(gtab.bvals, dtype=np.float64).tobytes())
+    sha.update(np.asarray(gtab.bvecs, dtype=np.float64).tobytes())
+    sha.update(repr(settings).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def saved_key(fname):
+    """
+    Returns the input key a tensor or peaks file was saved with, or None if
+    the file does not exist or predates input keys
+    """
+    if not op.isfile(fname):
+        return None
+    npz = np.load(fname)
+    if 'source' not in npz.files:
+        return None
+    return str(npz['source'])
+
+
+def save_tensors(ten, fname, mask, key=None):
+    """
+    Saves tensors as the six unique float32 components (Dxx, Dxy, Dyy, Dxz,
+    Dyz, Dzz) of each voxel inside the mask, plus the mask, in an
+    uncompressed .npz that tensor_file can memory map
+
+    **Positional Arguments:**
+
+            ten:
+                - Tensor fit, with evals and evecs
+            fname:
+                - Filename for the .npz
+            mask:
+                - 3D brain mask
+
+    **Optional Arguments:**
+
+            key:
+                - Key of the fit's inputs, as returned by input_key
+    """
+    mask = np.asarray(mask) > 0
+    evals = np.asarray(ten.evals[mask], dtype=np.float64)
+    evecs = np.asarray(ten.evecs[mask], dtype=np.float64)
+    quad = np.einsum('...ij,...j,...kj->...ik', evecs, evals, evecs)
+    lower = quad[:, [0, 1, 1, 2, 2, 2], [0, 0, 1, 0, 1, 2]]
+    arrays = dict(lower=lower.astype(np.float32), mask=mask)
+    if key is not None:
+        arrays['source'] = key
+    np.savez(fname, **arrays)
+
+
+class tensor_file(object):
+    def __init__(self, fname):
+        """
+        Reads tensors written by save_tensors. Eigenvalues, eigenvectors, FA
+        and MD are computed from the stored components on first use, as
+        float32 volumes on the full grid.
+
+        **Positional Arguments:**
+
+                fname:
+                    - Tensor .npz file
+        """
+        npz = np.load(fname)
+        if 'lower' not in npz.files:
+            raise ValueError("{} is not a tensor file written by "
+                             "save_tensors".format(fname))
+        self.mask = npz['mask'].astype(bool)
+        self.lower = mmap_npz(fname, 'lower')
+        if self.lower is None:
+            self.lower = npz['lower']
+        self._evals = None
+        self._evecs = None
+
+    def _scatter(self, values):
+        out = np.zeros(self.mask.shape + values.shape[1:], dtype=np.float32)
+        out[self.mask] = values
+        return out
+
+    def _decompose(self):
+        quad = np.asarray(self.lower, dtype=np.float64)[
+            :, [[0, 1, 3], [1, 2, 4], [3, 4, 5]]]
+        evals, evecs = np.linalg.eigh(quad)
+        # Descending eigenvalues, clipped at zero, as dipy orders them
+        self._evals = self._scatter(np.maximum(evals[:, ::-1], 0))
+        self._evecs = self._scatter(evecs[:, :, ::-1])
+
+    @property
+    def evals(self):
+        if self._evals is None:
+            self._decompose()
+        return self._evals
+
+    @property
+    def evecs(self):
+        if self._evecs is None:
+            self._decompose()
+        return self._evecs
+
+    @property
+    def fa(self):
+        return self._scatter(fractional_anisotropy(self.evals[self.mask]))
+
+    @property
+    def md(self):
+        return self.evals.mean(axis=-1)
+
+
+def mask_bounds(mask, margin):
+    """
+    Returns the bounding box of a mask, grown by a margin and clipped to the
+    volume, as a tuple of slices
+
+    **Positional Arguments:**
+
+            mask:
+                - 3D brain mask
+            margin:
+                - Number of voxels kept around the mask on each side
+    """
+    crop = []
+    for axis in range(mask.ndim):
+        other = tuple(a for a in range(mask.ndim) if a != axis)
+        inside = np.flatnonzero(np.asarray(mask > 0).any(axis=other))
+        if len(inside) == 0:
+            return tuple(slice(0, n) for n in mask.shape)
+        crop.append(slice(int(max(inside[0] - margin, 0)),
+                          int(min(inside[-1] + 1 + margin, mask.shape[axis]))))
+    return tuple(crop)
+
+
+def shift_batches(batches, offset):
+    """
+    Moves each streamline of a stream of batches by a voxel offset, such as
+    from a cropped grid back to the full one
+    """
+    for batch in batches:
+        yield [s + offset.astype(s.dtype) for s in batch]
+
+
+def tensor_slabs(shape, mask, budget):
+    """
+    Splits a volume into slabs of consecutive z slices whose tensor fit fits
+    in a memory budget. A slice costs its copy of the diffusion signal, plus
+    working space for each voxel inside the mask.
+
+    **Positional Arguments:**
+
+            shape:
+                - Shape of the 4D diffusion volume
+            mask:
+                - 3D brain mask
+            budget:
+                - Memory budget in bytes
+
+    **Returns:**
+
+            List of (z0, z1) slab bounds
+    """
+    nvols = shape[3]
+    # float64 signal, log-signal, weights and residuals plus 12 parameters
+    per_voxel = 8 * (4 * nvols + 12)
+    cost = (shape[0] * shape[1] * nvols * 8 +
+            (np.asarray(mask) > 0).sum(axis=(0, 1)) * per_voxel)
+    slabs, z0, used = [], 0, 0
+    for z in range(shape[2]):
+        if z > z0 and used + cost[z] > budget:
+            slabs.append((z0, z))
+            z0, used = z, 0
+        used += cost[z]
+    slabs.append((z0, shape[2]))
+    return slabs
+
+
+def read_slab(source, crop, z0, z1, dtype=None):
+    """
+    Reads z slices z0:z1 of a cropped 4D volume
+
+    **Positional Arguments:**
+
+            source:
+                - 4D array, .npy file (memory mapped), or nifti image file,
+                  of which only the slab is read
+            crop:
+                - Bounding box of the volume, as returned by mask_bounds, or
+                  None for the whole volume
+            z0, z1:
+                - Slice bounds relative to the bounding box
+
+    **Optional Arguments:**
+
+            dtype:
+                - Data type to return the slab as
+    """
+    if isinstance(source, str):
+        if source.endswith('.npy'):
+            source = np.load(source, mmap_mode='r')
+        else:
+            source = mgu.load_header(source).dataobj
+    if crop is None:
+        crop = tuple(slice(0, n) for n in source.shape[:3])
+    zs = slice(crop[2].start + z0, crop[2].start + z1)
+    slab = np.asarray(source[crop[0], crop[1], zs])
+    return slab if dtype is None else slab.astype(dtype)
+
+
+def _fit_slab(model, data, mask):
+    """
+    Returns the float32 tensor parameters of one slab of a volume
+    """
+    mask = np.asarray(mask) > 0
+    if not mask.any():
+        return np.zeros(mask.shape + (12,), dtype=np.float32)
+    return model.fit(np.asarray(data), mask).model_params.astype(np.float32)
+
+
+def _fit_slab_worker(args):
+    """
+    Pool worker for fit_tensors: reads and fits one slab of the volume.
+    """
+    model, source, crop, dtype, mask_path, z0, z1 = args
+    mask = np.load(mask_path, mmap_mode='r')
+    mask = mask[:, :, z0:z1]
+    if not np.any(mask):
+        return z0, z1, _fit_slab(model, None, mask)
+    return z0, z1, _fit_slab(model, read_slab(source, crop, z0, z1, dtype),
+                             mask)
+
+
+def fit_tensors(model, data, mask, budget=2 * 1024 ** 3, nproc=1, crop=None,
+                dtype=None):
+    """
+    Fits tensors slab by slab. Given an image file, its cropped volumes are
+    first streamed (decompressing the file once) into a scratch .npy file,
+    from which each slab is memory mapped as it is fit, in the workers when
+    fitting in parallel, so that only the parameters and the slabs being fit
+    are held in memory and peak memory is set by the budget rather than the
+    size of the volume. Voxels are fit independently, so the parameters
+    match a fit of the whole volume up to their float32 storage.
+
+    **Positional Arguments:**
+
+            model:
+                - dipy TensorModel
+            data:
+                - 4D diffusion volume, or nifti image file
+            mask:
+                - 3D brain mask, cropped like the volume
+
+    **Optional Arguments:**
+
+            budget:
+                - Memory budget in bytes of each slab's fit
+            nproc:
+                - Number of processes to fit slabs across
+            crop:
+                - Bounding box (see mask_bounds) of data to fit
+            dtype:
+                - Data type to read the diffusion signal as
+
+    **Returns:**
+
+            dipy TensorFit backed by preallocated float32 evals and evecs
+    """
+    mask = np.asarray(mask)
+    if isinstance(data, str):
+        nvols = mgu.load_header(data).shape[3]
+    else:
+        nvols = data.shape[3]
+    params = np.zeros(mask.shape + (12,), dtype=np.float32)
+    slabs = tensor_slabs(mask.shape + (nvols,), mask, budget)
+    source, scratch = data, None
+    if isinstance(data, str) or nproc > 1:
+        scratch = tempfile.mkdtemp(prefix='ndmg_tensor_')
+    try:
+        if isinstance(data, str):
+            # a z slab spans every volume, so slicing slabs out of a gzipped
+            # image would decompress all of it once per slab
+            source = op.join(scratch, 'data.npy')
+            if crop is None:
+                crop = tuple(slice(0, n) for n in mask.shape)
+            out = None
+            for i, vol in enumerate(mgu.iter_volumes(data, dtype)):
+                if out is None:
+                    out = np.lib.format.open_memmap(
+                        source, mode='w+', dtype=vol.dtype,
+                        shape=mask.shape + (nvols,))
+                out[..., i] = vol[crop]
+            del out
+            crop, dtype = None, None
+        elif nproc > 1:
+            source = op.join(scratch, 'data.npy')
+            np.save(source, data)
+        if nproc > 1:
+            mask_path = op.join(scratch, 'mask.npy')
+            np.save(mask_path, mask)
+            tasks = [(model, source, crop, dtype, mask_path, z0, z1)
+                     for z0, z1 in slabs]
+            pool = Pool(nproc)
+            try:
+                for z0, z1, slab in pool.imap_unordered(_fit_slab_worker,
+                                                        tasks):
+                    params[:, :, z0:z1] = slab
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for z0, z1 in slabs:
+                smask = mask[:, :, z0:z1]
+                sdata = None
+                if np.any(smask):
+                    sdata = read_slab(source, crop, z0, z1, dtype)
+                params[:, :, z0:z1] = _fit_slab(model, sdata, smask)
+    finally:
+        if scratch is not None:
+            shutil.rmtree(scratch)
+    return TensorFit(model, params)
+
+
+def _eudx_seeds(args):
+    """
+    Pool worker for parallel_eudx: tracks one chunk of seeds through the
+    memory mapped anisotropy and direction volumes.
+    """
+    seeds, fa_path, ind_path, vertices, stop_val = args
+    # Copy-on-write maps share the volumes' pages between workers while
+    # still handing EuDX writeable arrays
+    eu = EuDX(a=np.load(fa_path, mmap_mode='c'),
+              ind=np.load(ind_path, mmap_mode='c'), seeds=seeds,
+              odf_vertices=vertices, a_low=stop_val)
+    return [e for e in eu]
+
+
+def parallel_eudx(fa, ind, seeds, vertices, stop_val, nproc,
+                  batchsize=10000, chunks_per_proc=8):
+    """
+    Runs EuDX over contiguous chunks of seeds in a process pool. Each seed is
+    tracked independently, so concatenating the chunks in seed order gives
+    the same streamlines as one EuDX over every seed. The anisotropy and
+    quantized direction volumes are written once to a scratch directory and
+    memory mapped by every worker rather than pickled with each chunk. At
+    most two chunks per worker are in flight, so tracking runs ahead of the
+    consumer without queueing the whole tractogram.
+
+    **Positional Arguments:**
+
+            fa:
+                - Fractional anisotropy volume, or peak values
+            ind:
+                - Quantized principal directions, as returned by
+                  quantize_evecs, or peak indices
+            seeds:
+                - [nseeds]x3 array of seed voxels
+            vertices:
+                - Sphere vertices ind indexes into
+            stop_val:
+                - Value to cutoff fiber track
+            nproc:
+                - Number of worker processes
+
+    **Optional Arguments:**
+
+            batchsize:
+                - Largest number of seeds per chunk
+            chunks_per_proc:
+                - Smallest number of seed chunks handed to each worker, for
+                  load balancing
+
+    **Yields:**
+
+            List of the streamlines of each chunk, in seed order
+    """
+    scratch = tempfile.mkdtemp(prefix='ndmg_track_')
+    try:
+        fa_path = op.join(scratch, 'fa.npy')
+        ind_path = op.join(scratch, 'ind.npy')
+        np.save(fa_path, fa)
+        np.save(ind_path, ind)
+        chunksize = max(1, min(batchsize,
+                               -(-len(seeds) // (nproc * chunks_per_proc))))
+        pool = Pool(nproc)
+        try:
+            pending = deque()
+            for i in range(0, len(seeds), chunksize):
+                pending.append(pool.apply_async(
+                    _eudx_seeds, ((seeds[i:i + chunksize], fa_path, ind_path,
+                                   vertices, stop_val),)))
+                if len(pending) >= 2 * nproc:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        shutil.rmtree(scratch)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+# Copyright 2016 NeuroData (http://neurodata.io)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# fibers.py
+
+from __future__ import print_function
+
+import numpy as np
+import os.path as op
+import tempfile
+import zipfile
+import struct
+import shutil
+import os
+
+dtypes = ('float32', 'float16', 'int16')
+
+
+def flatten_streamlines(streamlines):
+    """
+    Concatenates a list of streamlines into one flat point array
+
+    **Positional Arguments:**
+
+            streamlines:
+                - List of [npoints]x3 arrays in a dipy EuDX or compatible
+                  format.
+
+    **Returns:**
+
+            points:
+                - [total npoints]x3 array of every streamline point
+            offsets:
+                - int64 array of length nlines + 1; streamline i owns
+                  points[offsets[i]:offsets[i+1]]
+    """
+    lengths = np.array([len(s) for s in streamlines], dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    if offsets[-1] == 0:
+        return np.empty((0, 3)), offsets
+    points = np.concatenate([np.asarray(s).reshape(-1, 3)
+                             for s in streamlines])
+    return points, offsets
+
+
+def mmap_npz(fname, name):
+    """
+    Memory maps an array stored uncompressed in an .npz file, as written by
+    np.savez
+
+    **Positional Arguments:**
+
+            fname:
+                - Filename of the .npz
+            name:
+                - Name of the array in the .npz
+
+    **Returns:**
+
+            Read-only memory map of the array, or None if the array is
+            compressed
+    """
+    zf = zipfile.ZipFile(fname)
+    try:
+        info = zf.getinfo(name + '.npy')
+    finally:
+        zf.close()
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(fname, 'rb') as f:
+        # The member's data follows its local header, whose name and extra
+        # fields may differ in length from the central directory's
+        f.seek(info.header_offset + 26)
+        nlen, xlen = struct.unpack('<HH', f.read(4))
+        f.seek(info.header_offset + 30 + nlen + xlen)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if not np.prod(shape):
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(fname, dtype=dtype, mode='r', offset=offset,
+                     shape=shape, order='F' if fortran else 'C')
+
+
+class tractogram(object):
+    def __init__(self, fibers):
+        """
+        Read access to a fibers file. Files written by fiber_writer are
+        memory mapped, so streamlines can be read by ID or in chunks without
+        loading the whole tractogram; older files holding a pickled array of
+        streamlines are loaded and flattened in memory.
+
+        **Positional Arguments:**
+
+                fibers:
+                    - Fibers file produced by ndmg_dwi_pipeline
+        """
+        npz = np.load(fibers, allow_pickle=True)
+        self.scale = None
+        if 'offsets' in npz.files:
+            self.points = mmap_npz(fibers, 'points')
+            if self.points is None:
+                self.points = npz['points']
+            self.offsets = npz['offsets']
+            if 'scale' in npz.files:
+                self.scale = float(npz['scale'])
+        else:
+            self.points, self.offsets = flatten_streamlines(
+                npz[npz.files[0]])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        """
+        Returns streamline idx as an [npoints]x3 float array
+        """
+        if idx < 0:
+            idx += len(self)
+        return self.decode(self.points[self.offsets[idx]:
+                                       self.offsets[idx + 1]])
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            for fib in chunk:
+                yield fib
+
+    def decode(self, points):
+        """
+        Converts stored points back to float coordinates: quantized points
+        are divided by their scale, and float16 points widened to float32
+        """
+        if self.scale is not None:
+            return points.astype(np.float32) / np.float32(self.scale)
+        return np.asarray(points,
+                          dtype=np.promote_types(points.dtype, np.float32))
+
+    def chunks(self, chunksize=100000):
+        """
+        Yields lists of at most chunksize consecutive streamlines
+
+        **Optional Arguments:**
+
+                chunksize:
+                    - Number of streamlines per chunk
+        """
+        for start in range(0, len(self), chunksize):
+            offsets = self.offsets[start:start + chunksize + 1]
+            points = self.decode(self.points[offsets[0]:offsets[-1]])
+            yield np.split(points, offsets[1:-1] - offsets[0])
+
+
+def load_fibers(fibers):
+    """
+    Loads the streamlines saved by ndmg_dwi_pipeline as a list of arrays
+    """
+    return list(tractogram(fibers))
+
+
+class fiber_writer(object):
+    def __init__(self, fibers, dtype='float32', scale=64):
+        """
+        Writes streamlines to a fibers file as they are produced. Points and
+        streamline lengths are appended to raw scratch files, and packed on
+        close into an uncompressed .npz of flat points and int64 offsets
+        (see flatten_streamlines) that tractogram can memory map, so memory
+        use does not grow with the tractogram.
+
+        **Positional Arguments:**
+
+                fibers:
+                    - Filename of the .npz to write
+
+        **Optional Arguments:**
+
+                dtype:
+                    - Storage type of the points: 'float32', 'float16'
+                      (about 3 significant digits), or 'int16' (quantized)
+                scale:
+                    - Quantization steps per voxel of int16 points, which
+                      must then lie within +/-32767/scale voxels
+        """
+        if dtype not in dtypes:
+            raise ValueError("Unknown fiber dtype {}; {} currently supported"
+                             .format(dtype, ", ".join(dtypes)))
+        self.fibers = fibers
+        self.dtype = np.dtype(dtype)
+        self.scale = scale if dtype == 'int16' else None
+        self.scratch = tempfile.mkdtemp(prefix='ndmg_fibers_')
+        self.points = open(op.join(self.scratch, 'points.raw'), 'wb')
+        self.counts = open(op.join(self.scratch, 'counts.raw'), 'wb')
+        self.npoints = 0
+
+    def write(self, streamlines):
+        """
+        Appends a batch of streamlines
+
+        **Positional Arguments:**
+
+                streamlines:
+                    - List of [npoints]x3 arrays in a dipy EuDX or compatible
+                      format.
+        """
+        points, offsets = flatten_streamlines(streamlines)
+        if self.scale is not None:
+            points = np.round(points * self.scale)
+            if len(points) and np.absolute(points).max() > 32767:
+                raise ValueError("Streamline points exceed the int16 range; "
+                                 "lower the quantization scale")
+        np.ascontiguousarray(points, dtype=self.dtype).tofile(self.points)
+        np.diff(offsets).tofile(self.counts)
+        self.npoints += len(points)
+
+    def close(self):
+        """
+        Writes the fibers file and removes the scratch files
+        """
+        try:
+            self.points.close()
+            self.counts.close()
+            if self.npoints:
+                points = np.memmap(self.points.name, dtype=self.dtype,
+                                   mode='r', shape=(self.npoints, 3))
+            else:
+                points = np.zeros((0, 3), dtype=self.dtype)
+            counts = np.fromfile(self.counts.name, dtype=np.int64)
+            offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            arrays = dict(points=points, offsets=offsets)
+            if self.scale is not None:
+                arrays['scale'] = self.scale
+            np.savez(self.fibers, **arrays)
+            del points
+        finally:
+            shutil.rmtree(self.scratch)
+
+
+def convert_fibers(fibers, out=None, dtype='float32', chunksize=100000):
+    """
+    Rewrites a fibers file, such as one holding a pickled array of
+    streamlines from an older ndmg_dwi_pipeline, in the flat format written
+    by fiber_writer
+
+    **Positional Arguments:**
+
+            fibers:
+                - Fibers file to convert
+
+    **Optional Arguments:**
+
+            out:
+                - Filename of the converted fibers; by default fibers is
+                  replaced
+            dtype:
+                - Storage type of the points (see fiber_writer)
+            chunksize:
+                - Number of streamlines converted at a time
+    """
+    out = fibers if out is None else out
+    fd, tmp = tempfile.mkstemp(suffix='.npz', dir=op.dirname(op.abspath(out)))
+    os.close(fd)
+    try:
+        writer = fiber_writer(tmp, dtype)
+        for chunk in tractogram(fibers).chunks(chunksize):
+            writer.write(chunk)
+        writer.close()
+        shutil.move(tmp, out)
+    finally:
+        if op.exists(tmp):
+            os.remove(tmp)
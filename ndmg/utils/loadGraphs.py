@@ -22,18 +22,91 @@
 from __future__ import print_function
 
 from collections import OrderedDict
+from scipy import sparse
 
 import networkx as nx
+import numpy as np
+import json
 import os
 
 
+def write_npz_graph(g, fname):
+    """
+    Writes a graph as the CSR arrays of its adjacency matrix in an .npz file,
+    along with the original node labels and the graph attributes. Only the
+    upper triangle of the (symmetric) adjacency is stored, and nodes are
+    numbered from 1 when read back, as with the other formats. Numeric edge
+    attributes other than the weight are kept as extra weight layers aligned
+    with the CSR data.
+
+    **Positional Arguments:**
+
+            g:
+                - NetworkX graph
+            fname:
+                - Filename for the graph
+    """
+    nodes = list(g.nodes())
+    index = dict((node, idx) for idx, node in enumerate(nodes))
+    edges = list(g.edges(data=True))
+    u = np.array([index[e[0]] for e in edges], dtype=np.int64)
+    v = np.array([index[e[1]] for e in edges], dtype=np.int64)
+    w = np.array([e[2].get('weight', 1) for e in edges])
+    names = set(k for e in edges for k, val in e[2].items()
+                if k != 'weight' and isinstance(val, (int, float)))
+    order = sparse.csr_matrix((np.arange(1, len(edges) + 1),
+                               (np.minimum(u, v), np.maximum(u, v))),
+                              shape=(len(nodes), len(nodes)))
+    idx = order.data - 1
+    layers = dict(('layer_' + name,
+                   np.array([edges[i][2].get(name, 0) for i in idx]))
+                  for name in names)
+    np.savez_compressed(fname, data=w[idx], indices=order.indices,
+                        indptr=order.indptr, labels=np.array(nodes),
+                        attrs=json.dumps(g.graph), **layers)
+
+
+def read_npz_graph(fname):
+    """
+    Reads a graph written by write_npz_graph
+
+    **Positional Arguments:**
+
+            fname:
+                - Filename of the graph
+    """
+    npz = np.load(fname)
+    n = len(npz['labels'])
+    adj = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']),
+                            shape=(n, n))
+    adj.has_canonical_format = True
+    adj = adj.tocoo()
+    g = nx.Graph()
+    g.graph.update(json.loads(str(npz['attrs'])))
+    g.add_nodes_from(range(1, n + 1))
+    names = [f[len('layer_'):] for f in npz.files if f.startswith('layer_')]
+    values = [adj.data] + [npz['layer_' + name] for name in names]
+    attrs = [dict(zip(['weight'] + names, vals)) for vals in
+             zip(*[val.tolist() for val in values])]
+    g.add_edges_from(zip((adj.row + 1).tolist(), (adj.col + 1).tolist(),
+                         attrs))
+    return g
+
+
+readers = {'.edgelist': nx.read_weighted_edgelist,
+           '.gpickle': nx.read_gpickle,
+           '.graphml': nx.read_graphml,
+           '.npz': read_npz_graph}
+
+
 def loadGraphs(filenames, verb=False):
     """
     Given a list of files, returns a dictionary of graphs
 
     Required parameters:
         filenames:
-            - List of filenames for graphs
+            - List of filenames for graphs. The format of each is chosen by
+              its extension: .edgelist, .gpickle, .graphml or .npz
     Optional parameters:
         verb:
             - Toggles verbose output statements
@@ -47,11 +120,10 @@ def loadGraphs(filenames, verb=False):
             print("Loading: " + files)
         #  Adds graphs to dictionary with key being filename
         fname = os.path.basename(files)
-        try:
-            gstruct[fname] = nx.read_weighted_edgelist(files) 
-        except:
-            try:
-                gstruct[fname] = nx.read_gpickle(files)
-            except:
-                gstruct[fname] = nx.read_graphml(files)
+        ext = os.path.splitext(fname)[1]
+        if ext not in readers:
+            raise ValueError("Unknown graph format for {}; edgelist, gpickle, "
+                             "graphml, and npz currently supported"
+                             .format(files))
+        gstruct[fname] = readers[ext](files)
     return gstruct
@@ -24,12 +24,412 @@ from __future__ import print_function
 from dipy.io import read_bvals_bvecs
 from dipy.core.gradients import gradient_table
 from subprocess import Popen, PIPE
+from collections import OrderedDict
+from datetime import timedelta
 import numpy as np
+from nibabel.openers import ImageOpener
 import nibabel as nb
 import os.path as op
+import tempfile
+import hashlib
+import shutil
+import os
+
+try:
+    from indexed_gzip import IndexedGzipFile
+except ImportError:
+    IndexedGzipFile = None
+import time
 import sys
 
 
+class image_cache(object):
+    def __init__(self, budget=2 * 1024 ** 3):
+        """
+        Process-wide LRU cache of decoded image arrays. Entries are keyed by
+        path and reloaded when the file's mtime changes; the least recently
+        used are evicted once the cached arrays exceed the byte budget.
+
+        **Optional Arguments:**
+
+                budget:
+                    - Maximum number of bytes of cached arrays
+        """
+        self.budget = budget
+        self.nbytes = 0
+        self.arrays = OrderedDict()
+
+    def load(self, fname, dtype=None):
+        """
+        Returns the (read-only) voxel data of an image, from the cache if
+        possible
+
+        **Positional Arguments:**
+
+                fname:
+                    - Path to a nifti image
+
+        **Optional Arguments:**
+
+                dtype:
+                    - Data type to read the voxels as (see read_data);
+                      cached separately from other types
+        """
+        path = op.abspath(fname)
+        key = (path, None if dtype is None else np.dtype(dtype).str)
+        mtime = op.getmtime(path)
+        entry = self.arrays.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1].nbytes
+            if entry[0] != mtime:
+                entry = None
+        if entry is None:
+            data = read_data(nb.load(path), dtype)
+            data.flags.writeable = False
+            entry = (mtime, data)
+        if entry[1].nbytes <= self.budget:
+            self.arrays[key] = entry
+            self.nbytes += entry[1].nbytes
+            self.evict()
+        return entry[1]
+
+    def evict(self):
+        """
+        Drops least recently used arrays until the cache fits its budget
+        """
+        while self.nbytes > self.budget:
+            _, (_, data) = self.arrays.popitem(last=False)
+            self.nbytes -= data.nbytes
+
+    def set_budget(self, budget):
+        """
+        Changes the byte budget of the cache, evicting entries as needed
+        """
+        self.budget = budget
+        self.evict()
+
+    def clear(self):
+        """
+        Empties the cache
+        """
+        self.arrays.clear()
+        self.nbytes = 0
+
+
+images = image_cache()
+
+
+def load_header(fname):
+    """
+    Opens an image for its metadata (shape, affine, header) only; the voxel
+    data is not read. Use load_data for the voxels.
+
+    **Positional Arguments:**
+
+            fname:
+                - Path to a nifti image
+    """
+    return nb.load(fname)
+
+
+def load_data(fname, dtype=None):
+    """
+    Returns the voxel data of an image through the process-wide image cache.
+    The array is shared with other callers and is read-only; copy it before
+    modifying it.
+
+    **Positional Arguments:**
+
+            fname:
+                - Path to a nifti image
+
+    **Optional Arguments:**
+
+            dtype:
+                - Data type to read the voxels as (see read_data)
+    """
+    return images.load(fname, dtype)
+
+
+def read_data(img, dtype=None):
+    """
+    Reads the voxel data of an image. By default this is nibabel's get_data,
+    which scales integer images to float64. With a dtype, the unscaled
+    on-disk values are read once and converted and scaled in that type, so
+    no float64 copy of the image is made.
+
+    **Positional Arguments:**
+
+            img:
+                - nibabel image
+
+    **Optional Arguments:**
+
+            dtype:
+                - Data type to read the voxels as, such as 'float32'
+    """
+    if dtype is None:
+        return img.get_data()
+    dtype = np.dtype(dtype)
+    proxy = img.dataobj
+    if not hasattr(proxy, 'get_unscaled'):
+        return np.asarray(proxy, dtype=dtype)
+    data = np.asarray(proxy.get_unscaled()).astype(dtype)
+    if proxy.slope != 1:
+        data *= dtype.type(proxy.slope)
+    if proxy.inter != 0:
+        data += dtype.type(proxy.inter)
+    return data
+
+
+def image_hash(fname, blocksize=2**20):
+    """
+    Returns the sha1 hex digest of an image's uncompressed contents. Unlike
+    the hash of a gzipped file, it does not change when an image is rewritten
+    with the same header and voxels.
+
+    **Positional Arguments:**
+
+            fname:
+                - Path to a (possibly gzipped) image
+    """
+    sha = hashlib.sha1()
+    with ImageOpener(fname, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def gzip_index(fname, spacing=4 * 1024 ** 2):
+    """
+    Returns an indexed_gzip file for a gzipped image. Seek points are added
+    as the file is read, so later reads only decompress from the nearest
+    seek point already passed. An index saved next to the image (see
+    save_gzip_index) is imported if it is newer than the image.
+
+    **Positional Arguments:**
+
+            fname:
+                - Path to a gzipped file
+
+    **Optional Arguments:**
+
+            spacing:
+                - Bytes of uncompressed data between seek points
+    """
+    index = fname + '.gzidx'
+    if op.isfile(index) and op.getmtime(index) >= op.getmtime(fname):
+        return IndexedGzipFile(fname, index_file=index)
+    return IndexedGzipFile(fname, spacing=spacing)
+
+
+def save_gzip_index(img, fname):
+    """
+    Saves the seek points of an image loaded by load_indexed next to it, as
+    <image>.gzidx, so that other processes reading it can import them
+    """
+    fobj = img.dataobj.file_like
+    if IndexedGzipFile is None or not isinstance(fobj, IndexedGzipFile):
+        return
+    # Export then rename, so concurrent readers never see a partial index.
+    # The index is only a speedup, so an unwritable directory is skipped.
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir=op.dirname(op.abspath(fname)))
+        os.close(fd)
+        fobj.export_index(tmp)
+        os.rename(tmp, fname + '.gzidx')
+    except (OSError, IOError):
+        pass
+    finally:
+        if tmp is not None and op.exists(tmp):
+            os.remove(tmp)
+
+
+_gzip_reads = {}
+
+
+def load_indexed(fname):
+    """
+    Loads the header of an image whose voxel data is read on demand. The
+    first read of a gzipped image in a process uses nibabel, which
+    decompresses the file only up to the data requested. When indexed_gzip
+    is installed, later reads (or any read of an image with a saved index)
+    go through gzip_index, so that slicing a volume or slice out of
+    img.dataobj decompresses from the nearest seek point.
+
+    **Positional Arguments:**
+
+            fname:
+                - Path to a nifti image
+    """
+    img = nb.load(fname)
+    if IndexedGzipFile is None or not fname.endswith('.gz'):
+        return img
+    key = (op.abspath(fname), op.getmtime(fname))
+    _gzip_reads[key] = _gzip_reads.get(key, 0) + 1
+    if _gzip_reads[key] == 1 and not op.isfile(fname + '.gzidx'):
+        return img
+    fobj = gzip_index(fname)
+    fmap = img.make_file_map({'image': fobj, 'header': fobj})
+    return img.from_file_map(fmap)
+
+
+def read_volume(fname, vol, dtype=None):
+    """
+    Reads one volume of a 4D image without loading the others. Seek points
+    of images read more than once are saved next to them (see
+    save_gzip_index).
+
+    **Positional Arguments:**
+
+            fname:
+                - Path to a 4D nifti image
+            vol:
+                - Index of the volume
+
+    **Optional Arguments:**
+
+            dtype:
+                - Data type to return the volume as
+    """
+    img = load_indexed(fname)
+    data = np.asarray(img.dataobj[:, :, :, vol])
+    save_gzip_index(img, fname)
+    if dtype is not None:
+        data = data.astype(dtype)
+    return data
+
+
+def iter_volumes(fname, dtype=None):
+    """
+    Yields the volumes of a 4D image one at a time, reading the file once
+    from start to end
+
+    **Positional Arguments:**
+
+            fname:
+                - Path to a 4D nifti image
+
+    **Optional Arguments:**
+
+            dtype:
+                - Data type to return the volumes as (see read_data)
+    """
+    img = nb.load(fname)
+    if not isinstance(img, nb.Nifti1Image):
+        for vol in range(img.shape[3]):
+            data = np.asarray(img.dataobj[:, :, :, vol])
+            yield data if dtype is None else data.astype(dtype)
+        return
+    proxy = img.dataobj
+    rawtype = img.header.get_data_dtype()
+    shape = img.shape[:3]
+    volsize = int(np.prod(shape)) * rawtype.itemsize
+    scaled = proxy.slope != 1 or proxy.inter != 0
+    if scaled and dtype is None:
+        # as nibabel scales them
+        dtype = np.float64
+    with ImageOpener(fname, 'rb') as f:
+        f.seek(int(proxy.offset))
+        for vol in range(img.shape[3]):
+            data = np.frombuffer(f.read(volsize), dtype=rawtype)
+            data = data.reshape(shape, order='F')
+            if dtype is None:
+                yield data
+                continue
+            data = data.astype(dtype)
+            if proxy.slope != 1:
+                data *= data.dtype.type(proxy.slope)
+            if proxy.inter != 0:
+                data += data.dtype.type(proxy.inter)
+            yield data
+
+
+class progress(object):
+    def __init__(self, total=None, interval=10, callback=None):
+        """
+        Tracks the throughput of graph building and reports it at most once
+        every interval seconds. Builders only call update once per chunk of
+        streamlines, so leaving progress off costs nothing.
+
+        **Optional Arguments:**
+
+                total:
+                    - Total number of streamlines, used for the ETA. Graph
+                      builders fill it in when it is None.
+                interval:
+                    - Minimum number of seconds between reports
+                callback:
+                    - Called with a dictionary of statistics at each report;
+                      defaults to print_progress
+        """
+        self.total = total
+        self.interval = interval
+        self.callback = print_progress if callback is None else callback
+        self.start = self.last = time.time()
+        self.streamlines = 0
+        self.points = 0
+        self.edges = 0
+
+    def update(self, streamlines, points, edges):
+        """
+        Records a processed chunk, reporting if the interval has elapsed
+
+        **Positional Arguments:**
+
+                streamlines:
+                    - Number of streamlines in the chunk
+                points:
+                    - Number of points in the chunk
+                edges:
+                    - Total number of distinct edges discovered so far
+        """
+        self.streamlines += streamlines
+        self.points += points
+        self.edges = edges
+        now = time.time()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.callback(self.stats(now))
+
+    def finish(self):
+        """
+        Reports the final statistics
+        """
+        self.callback(self.stats(time.time()))
+
+    def stats(self, now):
+        """
+        Returns a dictionary of the throughput statistics at time now
+        """
+        elapsed = max(now - self.start, 1e-9)
+        rate = self.streamlines / elapsed
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = (self.total - self.streamlines) / rate
+        return {'streamlines': self.streamlines, 'total': self.total,
+                'points': self.points, 'edges': self.edges,
+                'elapsed': elapsed, 'streamlines_per_sec': rate,
+                'points_per_sec': self.points / elapsed, 'eta': eta}
+
+
+def print_progress(stats):
+    """
+    Prints graph building statistics from progress on a single line
+    """
+    done = "{}".format(stats['streamlines'])
+    if stats['total']:
+        done += "/{} ({:.1f}%)".format(stats['total'], 100.0 *
+                                       stats['streamlines'] / stats['total'])
+    eta = ""
+    if stats['eta'] is not None:
+        eta = ", ETA {}".format(timedelta(seconds=int(stats['eta'])))
+    print("Streamlines: {}, {:.0f} streamlines/s, {:.0f} points/s, "
+          "{} edges{}".format(done, stats['streamlines_per_sec'],
+                              stats['points_per_sec'], stats['edges'], eta))
+
+
 def apply_mask(inp, masked, mask):
     """
     A function to apply a mask to a brain.
@@ -49,29 +449,29 @@ def apply_mask(inp, masked, mask):
 
 def load_bval_bvec_dwi(fbval, fbvec, dwi_file, dwi_file_out):
     """
-    Takes bval and bvec files and produces a structure in dipy format
+    Takes bval and bvec files and produces a structure in dipy format, and
+    writes the DWI without its spurious volumes (see drop_volumes)
 
     **Positional Arguments:**
-    """
-
-    # Load Data
-    img = nb.load(dwi_file)
-    data = img.get_data()
 
+            fbval:
+                - b-values file
+            fbvec:
+                - b-vectors file
+            dwi_file:
+                - DWI image file
+            dwi_file_out:
+                - Cleaned DWI image file. It may be a hard link to dwi_file,
+                  so it should not be written to.
+    """
     bvals, bvecs = read_bvals_bvecs(fbval, fbvec)
 
     # Get rid of spurrious scans
     idx = np.where((bvecs[:, 0] == 100) & (bvecs[:, 1] == 100) &
-                   (bvecs[:, 2] == 100))
+                   (bvecs[:, 2] == 100))[0]
     bvecs = np.delete(bvecs, idx, axis=0)
     bvals = np.delete(bvals, idx, axis=0)
-    data = np.delete(data, idx, axis=3)
-
-    # Save corrected DTI volume
-    dwi_new = nb.Nifti1Image(data, affine=img.get_affine(),
-                             header=img.get_header())
-    dwi_new.update_header()
-    nb.save(dwi_new, dwi_file_out)
+    drop_volumes(dwi_file, dwi_file_out, idx)
 
     gtab = gradient_table(bvals, bvecs, atol=0.01)
 
@@ -79,6 +479,64 @@ def load_bval_bvec_dwi(fbval, fbvec, dwi_file, dwi_file_out):
     return gtab
 
 
+def drop_volumes(in_file, out_file, idx):
+    """
+    Writes a 4D image without some of its volumes. The voxel data is never
+    loaded: if no volumes are dropped and both files are stored alike, the
+    output is a hard link to (or, across file systems, a copy of) the input;
+    otherwise the stored bytes of the kept volumes are streamed to the output
+    one volume at a time, so values, data type and scaling are unchanged.
+
+    **Positional Arguments:**
+
+            in_file:
+                - 4D nifti image file
+            out_file:
+                - Output nifti image file
+            idx:
+                - Indices of the volumes to drop
+    """
+    img = nb.load(in_file)
+    shape = img.shape
+    keep = np.setdiff1d(np.arange(shape[-1]), idx)
+    if op.exists(out_file):
+        os.remove(out_file)
+
+    if not isinstance(img, nb.Nifti1Image) or len(shape) != 4:
+        # Other formats have no single-file layout to stream; fall back to
+        # copying the kept volumes in memory
+        data = np.asarray(img.dataobj)[..., keep]
+        nb.save(nb.Nifti1Image(data, affine=img.affine, header=img.header),
+                out_file)
+        return
+
+    if len(keep) == shape[-1] and \
+            in_file.endswith('.gz') == out_file.endswith('.gz'):
+        try:
+            os.link(in_file, out_file)
+        except (OSError, AttributeError):
+            shutil.copyfile(in_file, out_file)
+        return
+
+    hdr = img.header.copy()
+    hdr.set_data_shape(shape[:3] + (len(keep),))
+    # nibabel moves the scaling from a loaded header to its data proxy
+    hdr.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
+    volsize = int(np.prod(shape[:3])) * hdr.get_data_dtype().itemsize
+    with ImageOpener(in_file, 'rb') as fin, \
+            ImageOpener(out_file, 'wb') as fout:
+        hdr.write_to(fout)
+        fout.write(b'\x00' * (int(hdr.get_data_offset()) - fout.tell()))
+        fin.seek(int(img.dataobj.offset))
+        for vol in range(shape[-1]):
+            buf = fin.read(volsize)
+            if len(buf) != volsize:
+                raise IOError("{} ends before its last volume"
+                              .format(in_file))
+            if vol in keep:
+                fout.write(buf)
+
+
 def load_bval_bvec(fbval, fbvec):
     """
     Takes bval and bvec files and produces a structure in dipy format
@@ -93,14 +551,27 @@ def load_bval_bvec(fbval, fbvec):
     return gtab
 
 
-def get_b0(gtab, data):
+def get_b0(gtab, data, dtype=None):
     """
     Takes bval and bvec files and produces a structure in dipy format
 
     **Positional Arguments:**
+
+            gtab:
+                - Gradient table
+            data:
+                - 4D DWI array, or path to a DWI image, from which only the
+                  b0 volume is read (see read_volume)
+
+    **Optional Arguments:**
+
+            dtype:
+                - Data type to read the b0 volume of a DWI image as
     """
 
     b0 = np.where(gtab.b0s_mask)[0]
+    if isinstance(data, str):
+        return read_volume(data, b0[0], dtype)
     b0_vol = np.squeeze(data[:, :, :, b0[0]])  # if more than 1, use first
     return b0_vol
 
@@ -125,9 +596,8 @@ def get_slice(mri, volid, sli):
             - the path to the destination for the slice.
     """
     mri_im = nb.load(mri)
-    data = mri_im.get_data()
     # get the slice at the desired volume
-    vol = np.squeeze(data[:, :, :, volid])
+    vol = read_volume(mri, volid)
 
     # Wraps volume in new nifti image
     head = mri_im.get_header()
@@ -12,6 +12,7 @@ setup(
         'ndmg.track',
         'ndmg.graph',
         'ndmg.stats',
+        'ndmg.timeseries',
         'ndmg.utils',
         'ndmg.scripts'
     ],
@@ -22,7 +23,8 @@ setup(
         'console_scripts': [
             'ndmg_dwi_pipeline=ndmg.scripts.ndmg_dwi_pipeline:main',
             'ndmg_bids=ndmg.scripts.ndmg_bids:main',
-            'ndmg_cloud=ndmg.scripts.ndmg_cloud:main'
+            'ndmg_cloud=ndmg.scripts.ndmg_cloud:main',
+            'ndmg_convert_fibers=ndmg.scripts.ndmg_convert_fibers:main'
     ]
     },
     version=VERSION,